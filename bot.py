@@ -1,18 +1,34 @@
 # Файл: bot.py
 # Главный файл для запуска бота.
 
+import asyncio
 import logging  # Импорт logging.
+
+# uvloop — более быстрый event loop (в том числе транспорт subprocess). Необязателен.
+# Ставится до импорта модулей проекта и PTB, чтобы всё, что создаётся при импорте, уже видело его политику.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    uvloop = None
+
 from telegram import Update
 
 from telegram.ext import (  # Импорт из telegram.ext.
     Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes
 )
 
-from config import TOKEN  # Импорт TOKEN.
-from utils import cleanup_temp_files, load_allowed_users  # Импорт из utils.
+from config import (  # Импорт настроек.
+    TOKEN, WEBHOOK_URL, WEBHOOK_PORT, POLLING_TIMEOUT, CONNECTION_POOL_SIZE, POOL_TIMEOUT,
+    CONNECT_TIMEOUT, READ_TIMEOUT
+)
+from utils import cleanup_temp_files_periodic, load_allowed_users  # Импорт из utils.
+from conversion import soffice_supervisor, warmup_converters
+from scanning import warmup_scanner
 from handlers import (  # Импорт всех обработчиков из handlers.
     start, help_booklet, add_user, remove_user, list_users,
-    handle_document_or_photo, button_callback, handle_text_input, error_handler
+    handle_document_or_photo, button_callback, handle_text_input, error_handler,
+    flush_allowed_users
 )
 
 # Настройка логирования (токен не логируется)
@@ -25,12 +41,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+if uvloop is not None:
+    logger.info("Используется uvloop")
+
+# Типы обновлений, для которых есть обработчики. Остальные Telegram не присылает вовсе.
+# При добавлении обработчиков других типов — расширить список.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 
 async def log_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Логирует почти каждое входящее обновление.
     Выполняется первым (group=-1).
     """
+    if not logger.isEnabledFor(logging.INFO):
+        return  # Уровень выше INFO — ничего не собираем и не форматируем.
+
     user = update.effective_user
     if not user:
         logger.info("Получено обновление без пользователя")
@@ -53,16 +79,64 @@ async def log_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = f"data: {update.callback_query.data}"
     else:
         msg_type = 'другое обновление'
-        text = str(update.to_dict())[:200]
+        text = repr(update)[:200]
+
+    logger.info("Обновление от %s (@%s): %s — %s", user_id, username, msg_type, text)
+
+async def post_init(application: Application) -> None:
+    """Запускает фоновые задачи после инициализации приложения."""
+    application.bot_data['allowed_users_lock'] = asyncio.Lock()
+    application.bot_data['soffice_task'] = asyncio.create_task(
+        soffice_supervisor(application.bot_data)
+    )
+    # Прогрев не блокирует старт: бот сразу начинает принимать обновления.
+    application.bot_data['warmup_task'] = asyncio.create_task(warmup_converters())
+    application.bot_data['scanner_warmup_task'] = asyncio.create_task(warmup_scanner())
+    # Очистка старых временных файлов — сразу после старта и дальше раз в час, вне event loop.
+    # PDF, ждущие выбора режима печати, не трогаем: сессия может длиться дольше часа.
+    application.bot_data['cleanup_task'] = asyncio.create_task(cleanup_temp_files_periodic(
+        in_use=lambda: {ud['pdf_path'] for ud in application.user_data.values() if ud.get('pdf_path')}
+    ))
+
+
+async def post_shutdown(application: Application) -> None:
+    """Останавливает фоновые задачи (в том числе soffice-слушатель) и сохраняет allowed_users."""
+    for key in ('warmup_task', 'scanner_warmup_task', 'cleanup_task', 'soffice_task'):
+        task = application.bot_data.pop(key, None)
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    # Отложенная запись allowed_users могла не успеть — сохраняем сейчас.
+    await flush_allowed_users(application.bot_data)
+
+    # Пул процессов создаётся лениво (handlers._get_pdf_pool) — его может и не быть.
+    pool = application.bot_data.pop('pdf_pool', None)
+    if pool:
+        pool.shutdown(wait=False, cancel_futures=True)
 
-    logger.info(f"Обновление от {user_id} (@{username}): {msg_type} — {text}")
 
 def main():
-    cleanup_temp_files()
-    logger.info("🤖 Запуск бота (600dpi PNM)")
+    logger.info("🤖 Запуск бота (600dpi TIFF)")
     allowed_users = load_allowed_users()
 
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .connection_pool_size(CONNECTION_POOL_SIZE)
+        .pool_timeout(POOL_TIMEOUT)
+        .connect_timeout(CONNECT_TIMEOUT)
+        .read_timeout(READ_TIMEOUT)
+        .get_updates_connection_pool_size(1)
+        .get_updates_pool_timeout(POLLING_TIMEOUT + 10)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Сохраняем allowed_users в bot_data, чтобы обработчики имели к ним доступ
     application.bot_data['allowed_users'] = allowed_users
@@ -87,7 +161,23 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))  # Обработчик текста (& - и, ~ - не).
     application.add_error_handler(error_handler)  # Обработчик ошибок.
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)  # Запускаем polling - опрос обновлений.
+    if WEBHOOK_URL:
+        # Webhook: Telegram сам присылает обновления, опроса нет совсем.
+        logger.info(f"Режим webhook, порт {WEBHOOK_PORT}")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}",
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        # Long polling: запрос висит до POLLING_TIMEOUT сек, пауза между запросами не нужна.
+        application.run_polling(
+            poll_interval=0.0,
+            timeout=POLLING_TIMEOUT,
+            allowed_updates=ALLOWED_UPDATES
+        )
 
 if __name__ == '__main__':  # Если файл запущен напрямую (не импортирован).
     main()  # Вызываем main.
@@ -17,6 +17,18 @@ ADMIN_ID = int(os.getenv('ADMIN_ID', '0'))
 if ADMIN_ID == 0:
     raise ValueError("❌ ADMIN_ID не задан! Укажите ADMIN_ID в .env файле")
 
+# Получение обновлений
+# Если задан WEBHOOK_URL (публичный https-адрес), бот работает через webhook, иначе — long polling.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Например: https://bot.example.com
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))  # Локальный порт, который слушает бот в режиме webhook.
+POLLING_TIMEOUT = 30  # Сколько секунд Telegram держит getUpdates открытым (long polling).
+# Параллельная обработка обновлений: пока один пользователь ждёт конвертацию, остальные обслуживаются.
+# Пул HTTP-соединений для запросов к Bot API (send/edit сообщений); getUpdates использует отдельное соединение.
+CONNECTION_POOL_SIZE = int(os.getenv('CONNECTION_POOL_SIZE', '32'))
+POOL_TIMEOUT = 30.0  # Сколько ждать свободного соединения из пула, сек.
+CONNECT_TIMEOUT = 10.0  # Установка соединения с Bot API, сек.
+READ_TIMEOUT = 60.0  # Ожидание ответа Bot API (отправка файлов бывает долгой), сек.
+
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20 МБ
 SUPPORTED_FORMATS = frozenset({
     '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx',
@@ -30,14 +42,31 @@ DEFAULT_SHEETS_PER_SIGNATURE = int(os.getenv('DEFAULT_SHEETS', '5'))  # Полу
 DEFAULT_COPIES = int(os.getenv('DEFAULT_COPIES', '1'))  # Получаем дефолтное количество копий, преобразовываем в int.
 PRINTER_NAME = os.getenv('PRINTER_NAME', 'Xerox_WorkCentre_3220')  # Получаем имя принтера из .env, с дефолтом.
 
+# Настройки конвертации
+# Постоянный процесс LibreOffice (soffice --accept), которому конвертации передаются через unoconv.
+SOFFICE_PORT = int(os.getenv('SOFFICE_PORT', '2002'))  # Порт UNO-слушателя soffice на 127.0.0.1.
+# Сколько тяжёлых конвертаций (LibreOffice, Ghostscript) может идти одновременно. По умолчанию — половина ядер, минимум 2.
+MAX_CONCURRENT_CONVERSIONS = int(os.getenv('MAX_CONCURRENT_CONVERSIONS', str(max(2, (os.cpu_count() or 2) // 2))))
+# Процессов в пуле для CPU-тяжёлой работы с PDF (сборка брошюр).
+PDF_POOL_WORKERS = int(os.getenv('PDF_POOL_WORKERS', str(min(4, os.cpu_count() or 1))))
+
 # Настройки сканирования
 # Здесь опции для сканирования.
-SCANNER_DEVICE = os.getenv('SCANNER_DEVICE', 'xerox_mfp:libusb:001:004')  # Получаем устройство сканера из .env, с дефолтом. Это может быть переопределено автоопределением.
+_DEFAULT_SCANNER_DEVICE = 'xerox_mfp:libusb:001:004'
+_SCANNER_DEVICE_ENV = os.getenv('SCANNER_DEVICE', '').strip()  # Устройство сканера из .env ('' или 'auto' — не задано).
+# Старый дефолт из шаблона install.sh закреплённым не считаем: номера libusb меняются после переподключения.
+_SCANNER_DEVICE_PINNED = _SCANNER_DEVICE_ENV not in ('', 'auto', _DEFAULT_SCANNER_DEVICE)
+SCANNER_DEVICE = _SCANNER_DEVICE_ENV if _SCANNER_DEVICE_PINNED else _DEFAULT_SCANNER_DEVICE  # Явно заданное устройство или дефолт.
+# Автоопределение (scanimage -L) — только если устройство не задано явно; SCAN_AUTODETECT=1 включает его принудительно.
+SCAN_AUTODETECT = os.getenv('SCAN_AUTODETECT', '0' if _SCANNER_DEVICE_PINNED else '1') == '1'
 SCAN_OPTIONS = {  # Создаем словарь (dict) с опциями сканирования. Словарь - это коллекция ключ-значение.
-    'format': 'pnm',  # Ключ 'format' со значением 'pnm' - формат вывода сканирования.
+    'format': 'tiff',  # Ключ 'format' - формат вывода сканирования. TIFF, в отличие от PNM, хранит DPI — img2pdf получает верный размер страницы.
     'resolution': '600',  # Ключ 'resolution' со значением '600' - разрешение в DPI.
     'mode': 'Lineart'  # Ключ 'mode' со значением 'Lineart' - режим сканирования (черно-белый).
 }
+# Раз в сколько секунд «будить» сканер (scanimage -n), чтобы первый скан не ждал переинициализации USB.
+# По умолчанию 0 — не будить: скан, пришедший во время прогрева, ждёт его окончания (до нескольких секунд).
+SCANNER_WARMUP_INTERVAL = float(os.getenv('SCANNER_WARMUP_INTERVAL', '0'))
 
 # Файлы
 # Здесь пути к файлам.
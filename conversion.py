@@ -5,70 +5,537 @@
 """
 
 import asyncio
+import hashlib
+import io
 import os
+import re
 import shutil
 import tempfile
 import logging
-import sys
-from typing import Optional
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
 from telegram import Update
 from telegram.ext import ContextTypes
 
+import img2pdf
 import pypdf
+from pypdf.generic import ContentStream, FloatObject, NameObject
 
-from utils import create_temp_copy
-from config import MAX_FILE_SIZE
+from utils import create_temp_copy, short_err
+from config import MAX_FILE_SIZE, SOFFICE_PORT, MAX_CONCURRENT_CONVERSIONS
 
 logger = logging.getLogger(__name__)
 
+# Ограничение одновременных запусков LibreOffice/Ghostscript: без него при наплыве пользователей
+# процессы (~150 МБ каждый у LibreOffice) конкурируют за CPU и память.
+_convert_sem: Optional[asyncio.Semaphore] = None
+
+
+def _get_convert_sem() -> asyncio.Semaphore:
+    """
+    Семафор конвертаций, создаётся при первом использовании — уже внутри работающего event loop.
+    На Python 3.9 примитив asyncio привязывается к циклу в момент создания, а модуль
+    импортируется раньше, чем bot.py ставит uvloop и PTB запускает свой цикл.
+    """
+    global _convert_sem
+    if _convert_sem is None:
+        _convert_sem = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
+    return _convert_sem
+
+# Кэши результатов конвертации: ключ — SHA-256 исходного файла (+ параметры).
+# LibreOffice, img2pdf и Ghostscript детерминированы, поэтому одинаковый вход даёт одинаковый выход.
+GRAY_CACHE_DIR = os.path.join(tempfile.gettempdir(), "gs_gray_cache")
+PDF_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pdf_conv_cache")
+CACHE_MAX_ENTRIES = 200
+# Лимит объёма на каждый кэш: на Fedora /tmp — это tmpfs, и кэш лежит в оперативной памяти.
+CACHE_MAX_BYTES = 100 * 1024 * 1024
+_HASH_CHUNK_SIZE = 1024 * 1024  # 1 МБ
+
+
+def _stage_and_hash(src: str, dst: str) -> tuple[int, str]:
+    """
+    Кладёт входной файл в рабочую директорию конвертера и за тот же проход
+    считает его размер и SHA-256 (ключ кэша).
+    Сначала пробует жёсткую ссылку — тогда данные только читаются для хэша;
+    иначе (другая ФС, нет прав) копирует блоками по 1 МБ, хэшируя на лету.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    buf = bytearray(_HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        with open(src, "rb") as fin, open(dst, "wb") as fout:
+            while n := fin.readinto(buf):
+                digest.update(view[:n])
+                fout.write(view[:n])
+                size += n
+        shutil.copystat(src, dst)
+        return size, digest.hexdigest()
+
+    with open(dst, "rb") as fin:
+        while n := fin.readinto(buf):
+            digest.update(view[:n])
+            size += n
+    return size, digest.hexdigest()
+
+
+def _img2pdf_write(image_paths: list[str], pdf_path: str) -> None:
+    """Собирает PDF из изображений через img2pdf (без перекодирования JPEG/PNG)."""
+    with open(pdf_path, "wb") as f:
+        img2pdf.convert(image_paths, outputstream=f)
+
+
+@contextmanager
+def _work_dir(workdir: Optional[str], name: str) -> Iterator[str]:
+    """
+    Рабочая директория шага конвертации.
+    Если передан workdir задания — подкаталог в нём (удалится вместе с workdir),
+    иначе — отдельная TemporaryDirectory.
+    """
+    if workdir:
+        path = os.path.join(workdir, name)
+        os.makedirs(path, exist_ok=True)
+        yield path
+    else:
+        with tempfile.TemporaryDirectory(prefix=f"{name}_") as tmpdir:
+            yield tmpdir
+
+
+def _evict_cache(cache_dir: str, max_entries: int, max_bytes: int = CACHE_MAX_BYTES) -> None:
+    """Удаляет самые давно использованные файлы кэша сверх лимитов числа и объёма (LRU по mtime)."""
+    try:
+        with os.scandir(cache_dir) as entries:
+            files = []
+            for entry in entries:
+                if entry.is_file():
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+    except FileNotFoundError:
+        return
+
+    count = len(files)
+    total = sum(size for _mtime, size, _path in files)
+    if count <= max_entries and total <= max_bytes:
+        return
+
+    files.sort()
+    for _mtime, size, path in files:
+        if count <= max_entries and total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить файл кэша {path}: {e}")
+            continue
+        count -= 1
+        total -= size
+
+
+def _pdf_cache_lookup(key: str, cache_dir: str = PDF_CACHE_DIR) -> Optional[str]:
+    """
+    Ищет готовый PDF в кэше. При попадании возвращает временную копию
+    (вызывающий код может её удалить), иначе None.
+    """
+    cached_path = os.path.join(cache_dir, f"{key}.pdf")
+    try:
+        if os.path.getsize(cached_path) <= 1024:
+            return None
+        os.utime(cached_path)  # отмечаем использование для LRU
+        result = create_temp_copy(cached_path, ".pdf")
+    except OSError:
+        return None
+    logger.info(f"PDF из кэша: {key}")
+    return result
+
+
+def _pdf_cache_store(key: str, path: str, cache_dir: str = PDF_CACHE_DIR) -> None:
+    """Кладёт PDF в кэш атомарно (через временный файл и os.replace) и чистит лишнее."""
+    cached_path = os.path.join(cache_dir, f"{key}.pdf")
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        os.close(fd)
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, cached_path)
+        tmp_path = None
+        _evict_cache(cache_dir, CACHE_MAX_ENTRIES)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить PDF в кэш: {e}")
+    finally:
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def _cache_key(digest: str, *params) -> str:
+    """Ключ кэша: SHA-256 входного файла плюс параметры конвертации."""
+    return "_".join([digest, *(str(p) for p in params)])
+
+
+# Операторы и имена, означающие цвет (не оттенки серого) в потоке содержимого страницы.
+# Проверка консервативная: любое совпадение — отправляем PDF в Ghostscript.
+_COLOR_CONTENT_RE = re.compile(
+    rb"(?<![A-Za-z0-9_/])(?:rg|RG|k|K|sc|SC|scn|SCN|BI)(?![A-Za-z0-9_])"
+    rb"|/Device(?:RGB|CMYK|N)|/Cal(?:RGB)|/Lab|/ICCBased|/Separation"
+)
+_GRAY_COLOR_SPACES = frozenset({"/DeviceGray", "/CalGray", "/G"})
+_MAX_FORM_DEPTH = 5
+
+
+def _resolve(obj):
+    """Разыменовывает косвенный объект pypdf (None остаётся None)."""
+    return obj.get_object() if obj is not None else None
+
+
+def _is_gray_color_space(color_space) -> bool:
+    """Проверяет, что цветовое пространство PDF — серое (DeviceGray, CalGray, ICC с 1 каналом, Indexed над серым)."""
+    color_space = _resolve(color_space)
+    if isinstance(color_space, str):
+        return color_space in _GRAY_COLOR_SPACES
+    if isinstance(color_space, list) and color_space:
+        family = _resolve(color_space[0])
+        if family == "/CalGray":
+            return True
+        if family == "/ICCBased" and len(color_space) > 1:
+            return _resolve(color_space[1]).get("/N") == 1
+        if family == "/Indexed" and len(color_space) > 1:
+            return _is_gray_color_space(color_space[1])
+    return False
+
+
+def _resources_are_gray(resources, depth: int = 0) -> bool:
+    """Проверяет ресурсы страницы/формы: цветовые пространства, изображения и вложенные формы."""
+    resources = _resolve(resources)
+    if not resources:
+        return True
+
+    if _resolve(resources.get("/Pattern")) or _resolve(resources.get("/Shading")):
+        return False
+
+    color_spaces = _resolve(resources.get("/ColorSpace")) or {}
+    if not all(_is_gray_color_space(cs) for cs in color_spaces.values()):
+        return False
+
+    xobjects = _resolve(resources.get("/XObject")) or {}
+    for xobj in xobjects.values():
+        xobj = _resolve(xobj)
+        subtype = xobj.get("/Subtype")
+        if subtype == "/Image":
+            if xobj.get("/ImageMask"):
+                continue
+            if not _is_gray_color_space(xobj.get("/ColorSpace")):
+                return False
+        elif subtype == "/Form":
+            if depth >= _MAX_FORM_DEPTH or _COLOR_CONTENT_RE.search(xobj.get_data()):
+                return False
+            if not _resources_are_gray(xobj.get("/Resources"), depth + 1):
+                return False
+        else:
+            return False
+    return True
+
+
+def _pdf_is_already_gray(path: str) -> bool:
+    """
+    Возвращает True, если PDF гарантированно не содержит цвета:
+    все цветовые пространства и изображения серые, в содержимом нет цветовых операторов.
+    При любом сомнении или ошибке разбора — False (пусть отработает Ghostscript).
+    """
+    try:
+        reader = pypdf.PdfReader(path)
+        for page in reader.pages:
+            if _resolve(page.get("/Annots")):
+                return False
+            contents = page.get_contents()
+            if contents is not None and _COLOR_CONTENT_RE.search(contents.get_data()):
+                return False
+            if not _resources_are_gray(page.get("/Resources")):
+                return False
+        return True
+    except Exception as e:
+        logger.debug(f"Не удалось проверить цветность {path}: {e}")
+        return False
+
+
+# Постоянный слушатель LibreOffice: избавляет от 1–3 с запуска soffice на каждый документ.
+# Отдельный профиль, чтобы разовый `libreoffice --convert-to` (фоллбэк) не цеплялся к слушателю.
+SOFFICE_CONNECTION = f"socket,host=127.0.0.1,port={SOFFICE_PORT};urp;"
+SOFFICE_PROFILE_DIR = os.path.join(tempfile.gettempdir(), "tpb_soffice_profile")
+SOFFICE_RESTART_DELAY = 5.0
+# Слушатель — один процесс soffice: параллельные unoconv к нему сериализуются внутри LibreOffice
+# и могут уронить его, поэтому конвертации встают к слушателю в очередь по одной.
+_soffice_lock: Optional[asyncio.Lock] = None
+
+
+def _get_soffice_lock() -> asyncio.Lock:
+    """Замок слушателя; как и семафор конвертаций, создаётся лениво внутри работающего event loop."""
+    global _soffice_lock
+    if _soffice_lock is None:
+        _soffice_lock = asyncio.Lock()
+    return _soffice_lock
+
+
+async def soffice_supervisor(bot_data: dict) -> None:
+    """
+    Держит запущенным soffice-слушатель и перезапускает его при падении.
+    Текущий процесс хранится в bot_data['soffice']. Завершается отменой задачи.
+    """
+    if not shutil.which("soffice") or not shutil.which("unoconv"):
+        logger.warning("soffice или unoconv не найдены — конвертация будет запускать LibreOffice на каждый файл")
+        return
+
+    cmd = [
+        "soffice",
+        "--headless",
+        "--invisible",
+        "--nologo",
+        "--nodefault",
+        "--norestore",
+        "--nofirststartwizard",
+        f"-env:UserInstallation=file://{SOFFICE_PROFILE_DIR}",
+        f"--accept={SOFFICE_CONNECTION}StarOffice.ComponentContext",
+    ]
+    process = None
+    try:
+        while True:
+            logger.info(f"Запускаю soffice-слушатель на порту {SOFFICE_PORT}")
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL
+                )
+            except OSError as e:
+                logger.error(f"Не удалось запустить soffice-слушатель: {e}")
+                return
+            bot_data['soffice'] = process
+            returncode = await process.wait()
+            bot_data.pop('soffice', None)
+            logger.warning(f"soffice-слушатель завершился (код {returncode}), перезапуск через {SOFFICE_RESTART_DELAY:.0f} сек")
+            await asyncio.sleep(SOFFICE_RESTART_DELAY)
+    finally:
+        bot_data.pop('soffice', None)
+        if process is not None and process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=10.0)
+            except asyncio.TimeoutError:
+                process.kill()
+
+
+async def warmup_converters() -> None:
+    """
+    Прогревает LibreOffice (кэш fontconfig, файлы программы в page cache) и Ghostscript (ресурсы)
+    пустой конвертацией при старте, чтобы первый пользователь не платил за холодный запуск.
+    Ошибки только логируются.
+    """
+    with tempfile.TemporaryDirectory(prefix="warmup_") as tmpdir:
+        sample = os.path.join(tmpdir, "warmup.txt")
+        with open(sample, "w") as f:
+            f.write("warmup\n")
+
+        warmups = [
+            (_libreoffice_convert_cmd(sample, tmpdir), 180.0, "прогрев LibreOffice"),
+            (["gs", "-q", "-sDEVICE=pdfwrite", "-o", os.devnull, "-c", "quit"], 60.0, "прогрев Ghostscript"),
+        ]
+        for cmd, timeout, description in warmups:
+            start = time.monotonic()
+            try:
+                await run_subprocess(cmd, timeout=timeout, description=description)
+                logger.info(f"{description}: {time.monotonic() - start:.1f} сек")
+            except Exception as e:
+                logger.warning(f"{description} не удался: {e}")
+
+
+def _libreoffice_convert_cmd(input_path: str, outdir: str) -> list[str]:
+    """
+    Разовый `libreoffice --convert-to pdf` со своим профилем в outdir.
+    Второй soffice на общем профиле не конвертирует сам, а передаёт задание уже запущенному
+    и выходит без результата — а таких запусков одновременно может быть несколько.
+    """
+    return [
+        "libreoffice",
+        "--headless",
+        f"-env:UserInstallation=file://{os.path.join(outdir, 'lo_profile')}",
+        "--convert-to", "pdf",
+        "--outdir", outdir,
+        input_path
+    ]
+
+
+def _soffice_listener_alive(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Проверяет, что soffice-слушатель запущен и можно конвертировать через unoconv."""
+    process = context.bot_data.get('soffice')
+    return process is not None and process.returncode is None
+
+
+# Операторы, которые нельзя тривиально перевести в серый без Ghostscript
+# (цвет через именованные пространства, inline-изображения, вызов XObject, тени).
+_INPLACE_UNSUPPORTED_OPS = frozenset({b"cs", b"CS", b"sc", b"SC", b"scn", b"SCN", b"BI", b"Do", b"sh"})
+
+
+def _rgb_to_gray(r: float, g: float, b: float) -> float:
+    """Яркость по ITU-R BT.601."""
+    return 0.299 * r + 0.587 * g + 0.114 * b
+
+
+def _cmyk_to_gray(c: float, m: float, y: float, k: float) -> float:
+    """Серый для CMYK: 1 − (яркость чернил), с ограничением [0, 1]."""
+    return max(0.0, 1.0 - min(1.0, 0.3 * c + 0.59 * m + 0.11 * y + k))
+
+
+def _gray_inplace_pypdf(src: str, dst: str) -> bool:
+    """
+    Переводит в серый векторный PDF без растровых изображений прямо средствами pypdf:
+    операторы rg/RG и k/K в потоках содержимого заменяются на g/G с пересчитанной яркостью,
+    /Group /CS страниц — на /DeviceGray. Ghostscript при этом не запускается.
+    Возвращает False (и ничего не пишет), если PDF не подходит — тогда нужен Ghostscript.
+    """
+    try:
+        reader = pypdf.PdfReader(src)
+        writer = pypdf.PdfWriter()
+        writer.append(reader)
+
+        for page in writer.pages:
+            if _resolve(page.get("/Annots")):
+                return False
+            resources = _resolve(page.get("/Resources")) or {}
+            if any(_resolve(resources.get(key)) for key in ("/XObject", "/Pattern", "/Shading")):
+                return False
+            color_spaces = _resolve(resources.get("/ColorSpace")) or {}
+            if not all(_is_gray_color_space(cs) for cs in color_spaces.values()):
+                return False
+
+            contents = page.get_contents()
+            if contents is None:
+                continue
+            content = ContentStream(contents, writer)
+            operations = []
+            for operands, operator in content.operations:
+                if operator in _INPLACE_UNSUPPORTED_OPS:
+                    return False
+                if operator in (b"rg", b"RG"):
+                    gray = _rgb_to_gray(*(float(v) for v in operands))
+                    operands, operator = [FloatObject(round(gray, 4))], (b"g" if operator == b"rg" else b"G")
+                elif operator in (b"k", b"K"):
+                    gray = _cmyk_to_gray(*(float(v) for v in operands))
+                    operands, operator = [FloatObject(round(gray, 4))], (b"g" if operator == b"k" else b"G")
+                operations.append((operands, operator))
+            content.operations = operations
+            page.replace_contents(content)
+
+            group = _resolve(page.get("/Group"))
+            if group is not None and "/CS" in group:
+                group[NameObject("/CS")] = NameObject("/DeviceGray")
+
+        with open(dst, "wb") as f:
+            writer.write(f)
+        return True
+    except Exception as e:
+        logger.debug(f"pypdf-grayscale не подошёл для {src}: {e}")
+        return False
+
+
+# Debounce правок сообщений о прогрессе: каждая правка — HTTP-запрос к Bot API,
+# а промежуточные статусы, сменившиеся быстрее PROGRESS_DEBOUNCE, пользователь всё равно не увидит.
+PROGRESS_DEBOUNCE = 0.5  # сек
+_LAST_EDIT: dict[tuple[int, int], float] = {}
+_LAST_EDIT_MAX_ENTRIES = 1024
+
+
+def _mark_progress_edit(chat_id: int, message_id: int) -> None:
+    """Запоминает время последнего изменения сообщения о прогрессе."""
+    if len(_LAST_EDIT) >= _LAST_EDIT_MAX_ENTRIES:
+        _LAST_EDIT.clear()  # старые записи больше не нужны — интервал давно истёк
+    _LAST_EDIT[(chat_id, message_id)] = time.monotonic()
+
 
 async def send_progress_message(
     context: ContextTypes.DEFAULT_TYPE,
     chat_id: int,
     message_id: Optional[int] = None,
-    text: str = ""
+    text: str = "",
+    force: bool = False
 ) -> int:
     """
     Отправляет или редактирует сообщение с прогрессом.
     Возвращает message_id для последующих редактирований.
+    Правки чаще PROGRESS_DEBOUNCE пропускаются; force=True — для итоговых сообщений (ошибка/готово).
     """
     if message_id:
+        if not force and time.monotonic() - _LAST_EDIT.get((chat_id, message_id), 0.0) < PROGRESS_DEBOUNCE:
+            return message_id
         try:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=message_id,
                 text=text
             )
+            _mark_progress_edit(chat_id, message_id)
             return message_id
         except Exception:
             pass  # если сообщение удалено или ошибка — отправим новое
 
     sent = await context.bot.send_message(chat_id=chat_id, text=text)
+    _mark_progress_edit(chat_id, sent.message_id)
     return sent.message_id
 
 
+STDERR_LIMIT = 64 * 1024  # Больше 64 КБ stderr для диагностики не нужно.
+
+
+async def _drain_limited(stream: asyncio.StreamReader, limit: int) -> bytes:
+    """Вычитывает поток до конца, сохраняя не больше limit байт (остальное отбрасывается)."""
+    buf = bytearray()
+    while chunk := await stream.read(4096):
+        if len(buf) < limit:
+            buf.extend(chunk[:limit - len(buf)])
+    return bytes(buf)
+
+
 async def run_subprocess(
     cmd: list[str],
     timeout: float = 120.0,
     cwd: Optional[str] = None,
-    description: str = "выполнение команды"
+    description: str = "выполнение команды",
+    capture_stdout: bool = False
 ) -> tuple[bytes, bytes]:
     """
     Асинхронный запуск внешней команды с таймаутом и логированием ошибок.
+    stdout по умолчанию отбрасывается (capture_stdout=True — вернуть его целиком),
+    stderr сохраняется не больше STDERR_LIMIT байт, чтобы болтливый процесс не раздувал память.
     """
     logger.info(f"Запускаю: {' '.join(cmd)}")
     
     try:
         process = await asyncio.create_subprocess_exec(
             *cmd,
-            stdout=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
             stderr=asyncio.subprocess.PIPE,
             cwd=cwd
         )
 
+        async def _collect() -> tuple[bytes, bytes]:
+            if capture_stdout:
+                stdout, stderr = await asyncio.gather(
+                    process.stdout.read(),
+                    _drain_limited(process.stderr, STDERR_LIMIT)
+                )
+            else:
+                stdout, stderr = b"", await _drain_limited(process.stderr, STDERR_LIMIT)
+            await process.wait()
+            return stdout, stderr
+
         try:
-            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+            stdout, stderr = await asyncio.wait_for(_collect(), timeout=timeout)
         except asyncio.TimeoutError:
             process.terminate()
             try:
@@ -94,41 +561,65 @@ async def convert_to_pdf(
     context: ContextTypes.DEFAULT_TYPE,
     input_file: str,
     input_ext: str,
-    grayscale: bool = True
+    grayscale: bool = True,
+    workdir: Optional[str] = None
 ) -> str:
     """
     Асинхронно конвертирует офисный документ в PDF с помощью LibreOffice.
     Поддерживает индикаторы прогресса.
+    workdir — общая временная директория задания: шаги работают в её подкаталогах
+    вместо собственных TemporaryDirectory. Результат всегда копируется за её пределы.
     """
     chat_id = update.effective_chat.id
     progress_msg_id = None
 
-    progress_msg_id = await send_progress_message(
-        context, chat_id, progress_msg_id,
-        f"📄 Конвертирую {input_ext.upper()} → PDF…"
-    )
-
-    with tempfile.TemporaryDirectory(prefix="conv_to_pdf_") as tmpdir:
+    with _work_dir(workdir, "conv_to_pdf") as tmpdir:
         try:
             temp_input = os.path.join(tmpdir, os.path.basename(input_file))
-            shutil.copy2(input_file, temp_input)
+            input_size, digest = _stage_and_hash(input_file, temp_input)
+
+            cache_key = _cache_key(digest, input_ext, int(grayscale))
+            cached = _pdf_cache_lookup(cache_key)
+            if cached:
+                return cached
+
+            progress_msg_id = await send_progress_message(
+                context, chat_id, progress_msg_id,
+                f"📄 Конвертирую {input_ext.upper()} → PDF…"
+            )
 
             pdf_name = os.path.splitext(os.path.basename(temp_input))[0] + ".pdf"
             pdf_path = os.path.join(tmpdir, pdf_name)
 
-            cmd = [
-                "libreoffice",
-                "--headless",
-                "--convert-to", "pdf",
-                "--outdir", tmpdir,
-                temp_input
-            ]
-
-            await run_subprocess(
-                cmd,
-                timeout=90.0 + os.path.getsize(input_file) // (1024 * 1024) * 8,  # ~8 сек на МБ
-                description="конвертация в PDF (LibreOffice)"
-            )
+            timeout = 90.0 + input_size // (1024 * 1024) * 8  # ~8 сек на МБ
+            converted = False
+
+            if _soffice_listener_alive(context):
+                cmd = [
+                    "unoconv",
+                    "-f", "pdf",
+                    "-c", f"{SOFFICE_CONNECTION}StarOffice.ComponentContext",
+                    "-o", pdf_path,
+                    temp_input
+                ]
+                try:
+                    async with _get_soffice_lock(), _get_convert_sem():
+                        await run_subprocess(
+                            cmd,
+                            timeout=timeout,
+                            description="конвертация в PDF (unoconv)"
+                        )
+                    converted = True
+                except RuntimeError as e:
+                    logger.warning(f"unoconv не справился, запускаю LibreOffice напрямую: {e}")
+
+            if not converted:
+                async with _get_convert_sem():
+                    await run_subprocess(
+                        _libreoffice_convert_cmd(temp_input, tmpdir),
+                        timeout=timeout,
+                        description="конвертация в PDF (LibreOffice)"
+                    )
 
             if not os.path.exists(pdf_path):
                 raise RuntimeError("PDF после конвертации не найден")
@@ -138,7 +629,13 @@ async def convert_to_pdf(
                     context, chat_id, progress_msg_id,
                     "🖤 Применяю чёрно-белый режим (grayscale)…"
                 )
-                pdf_path = await convert_pdf_to_grayscale(update, context, pdf_path)
+                # Результат grayscale уже лежит вне рабочей директории — отдаём его без лишней копии.
+                gray_path, is_gray = await _grayscale_pdf(update, context, pdf_path, workdir=workdir)
+                if is_gray:  # Цветной оригинал после сбоя Ghostscript в кеш не кладём — в следующий раз повторим.
+                    _pdf_cache_store(cache_key, gray_path)
+                return gray_path
+
+            _pdf_cache_store(cache_key, pdf_path)
 
             return create_temp_copy(pdf_path, ".pdf")
 
@@ -146,7 +643,8 @@ async def convert_to_pdf(
             if progress_msg_id:
                 await send_progress_message(
                     context, chat_id, progress_msg_id,
-                    f"❌ Ошибка конвертации: {str(e)[:120]}"
+                    f"❌ Ошибка конвертации: {short_err(e)}",
+                    force=True
                 )
             raise
 
@@ -155,7 +653,8 @@ async def convert_image_to_pdf(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     image_path: str,
-    grayscale: bool = True
+    grayscale: bool = True,
+    workdir: Optional[str] = None
 ) -> str:
     """
     Асинхронно конвертирует изображение в PDF с помощью img2pdf.
@@ -164,26 +663,26 @@ async def convert_image_to_pdf(
     chat_id = update.effective_chat.id
     progress_msg_id = None
 
-    progress_msg_id = await send_progress_message(
-        context, chat_id, progress_msg_id,
-        "🖼️ Конвертирую изображение → PDF…"
-    )
-
-    with tempfile.TemporaryDirectory(prefix="conv_img_pdf_") as tmpdir:
+    with _work_dir(workdir, "conv_img_pdf") as tmpdir:
         try:
             temp_image = os.path.join(tmpdir, os.path.basename(image_path))
-            shutil.copy2(image_path, temp_image)
-
-            pdf_path = os.path.join(tmpdir, "image.pdf")
+            _size, digest = _stage_and_hash(image_path, temp_image)
 
-            cmd = [sys.executable, "-m", "img2pdf", temp_image, "--output", pdf_path]
+            cache_key = _cache_key(digest, os.path.splitext(image_path)[1].lower(), int(grayscale))
+            cached = _pdf_cache_lookup(cache_key)
+            if cached:
+                return cached
 
-            await run_subprocess(
-                cmd,
-                timeout=45.0,
-                description="конвертация изображения (img2pdf)"
+            progress_msg_id = await send_progress_message(
+                context, chat_id, progress_msg_id,
+                "🖼️ Конвертирую изображение → PDF…"
             )
 
+            pdf_path = os.path.join(tmpdir, "image.pdf")
+
+            # img2pdf — библиотека: вызываем в потоке, без запуска отдельного интерпретатора.
+            await asyncio.to_thread(_img2pdf_write, [temp_image], pdf_path)
+
             if not os.path.exists(pdf_path):
                 raise RuntimeError("PDF после img2pdf не найден")
 
@@ -192,7 +691,13 @@ async def convert_image_to_pdf(
                     context, chat_id, progress_msg_id,
                     "🖤 Применяю чёрно-белый режим…"
                 )
-                pdf_path = await convert_pdf_to_grayscale(update, context, pdf_path)
+                # Результат grayscale уже лежит вне рабочей директории — отдаём его без лишней копии.
+                gray_path, is_gray = await _grayscale_pdf(update, context, pdf_path, workdir=workdir)
+                if is_gray:  # Цветной оригинал после сбоя Ghostscript в кеш не кладём — в следующий раз повторим.
+                    _pdf_cache_store(cache_key, gray_path)
+                return gray_path
+
+            _pdf_cache_store(cache_key, pdf_path)
 
             return create_temp_copy(pdf_path, ".pdf")
 
@@ -200,7 +705,8 @@ async def convert_image_to_pdf(
             if progress_msg_id:
                 await send_progress_message(
                     context, chat_id, progress_msg_id,
-                    f"❌ Ошибка конвертации изображения: {str(e)[:120]}"
+                    f"❌ Ошибка конвертации изображения: {short_err(e)}",
+                    force=True
                 )
             raise
 
@@ -208,25 +714,59 @@ async def convert_image_to_pdf(
 async def convert_pdf_to_grayscale(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
-    pdf_path: str
+    pdf_path: str,
+    workdir: Optional[str] = None
 ) -> str:
     """
     Асинхронно конвертирует PDF в grayscale с помощью Ghostscript.
-    При ошибке поднимает исключение (не возвращает цветной оригинал молча).
+    При ошибке сообщает пользователю и возвращает копию цветного оригинала (печать важнее ч/б).
+    workdir — общая временная директория задания (см. convert_to_pdf).
+    """
+    gray_path, _is_gray = await _grayscale_pdf(update, context, pdf_path, workdir=workdir)
+    return gray_path
+
+
+async def _grayscale_pdf(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    pdf_path: str,
+    workdir: Optional[str] = None
+) -> tuple[str, bool]:
+    """
+    Реализация convert_pdf_to_grayscale. Возвращает (путь, получился ли grayscale):
+    False — это копия оригинала после ошибки, кешировать её как ч/б нельзя.
     """
     chat_id = update.effective_chat.id
-    progress_msg_id = await send_progress_message(
-        context, chat_id, None,  # новое сообщение, т.к. предыдущее может быть уже отредактировано
-        "🖤 Конвертация в grayscale (Ghostscript)…"
-    )
 
-    with tempfile.TemporaryDirectory(prefix="pdf_gray_") as tmpdir:
+    if await asyncio.to_thread(_pdf_is_already_gray, pdf_path):
+        logger.info("PDF уже в оттенках серого — Ghostscript не нужен")
+        return create_temp_copy(pdf_path, ".pdf"), True
+
+    progress_msg_id = None
+
+    with _work_dir(workdir, "pdf_gray") as tmpdir:
         try:
             temp_input = os.path.join(tmpdir, "input.pdf")
-            shutil.copy2(pdf_path, temp_input)
+            _size, digest = _stage_and_hash(pdf_path, temp_input)
+
+            cache_key = _cache_key(digest)
+            cached = _pdf_cache_lookup(cache_key, GRAY_CACHE_DIR)
+            if cached:
+                return cached, True
 
             output_path = os.path.join(tmpdir, "gray.pdf")
 
+            # Векторный PDF без изображений переводим в серый без запуска Ghostscript.
+            if await asyncio.to_thread(_gray_inplace_pypdf, temp_input, output_path):
+                logger.info("Grayscale выполнен через pypdf (без Ghostscript)")
+                _pdf_cache_store(cache_key, output_path, GRAY_CACHE_DIR)
+                return create_temp_copy(output_path, ".pdf"), True
+
+            progress_msg_id = await send_progress_message(
+                context, chat_id, None,  # новое сообщение, т.к. предыдущее может быть уже отредактировано
+                "🖤 Конвертация в grayscale (Ghostscript)…"
+            )
+
             cmd = [
                 "gs",
                 "-q",
@@ -241,39 +781,51 @@ async def convert_pdf_to_grayscale(
                 temp_input
             ]
 
-            await run_subprocess(
-                cmd,
-                timeout=60.0,
-                description="конвертация в grayscale (Ghostscript)"
-            )
+            async with _get_convert_sem():
+                await run_subprocess(
+                    cmd,
+                    timeout=60.0,
+                    description="конвертация в grayscale (Ghostscript)"
+                )
 
             if not os.path.exists(output_path) or os.path.getsize(output_path) < 1024:
                 raise RuntimeError("Созданный grayscale PDF пустой или слишком маленький")
 
-            return create_temp_copy(output_path, ".pdf")
+            _pdf_cache_store(cache_key, output_path, GRAY_CACHE_DIR)
+
+            return create_temp_copy(output_path, ".pdf"), True
 
         except Exception as e:
             await send_progress_message(
                 context, chat_id, progress_msg_id,
-                "⚠️ Не удалось сделать ч/б версию — печатаем оригинал"
+                "⚠️ Не удалось сделать ч/б версию — печатаем оригинал",
+                force=True
             )
             logger.error(f"Grayscale failed: {e}", exc_info=True)
             # Если очень важно — можно здесь raise, но для usability оставляем fallback
-            return create_temp_copy(pdf_path, ".pdf")
+            return create_temp_copy(pdf_path, ".pdf"), False
 
 
-def create_blank_pdf() -> str:
-    """Создаёт пустую PDF-страницу формата A4."""
-    with tempfile.TemporaryDirectory(prefix="blank_pdf_") as tmpdir:
-        try:
-            writer = pypdf.PdfWriter()
-            writer.add_blank_page(width=595, height=842)  # A4
+def _build_blank_pdf_bytes() -> bytes:
+    """Строит пустую страницу A4 в памяти (один раз при импорте)."""
+    writer = pypdf.PdfWriter()
+    writer.add_blank_page(width=595, height=842)  # A4
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
 
-            pdf_path = os.path.join(tmpdir, "blank.pdf")
-            with open(pdf_path, "wb") as f:
-                writer.write(f)
 
-            return create_temp_copy(pdf_path, ".pdf")
-        except Exception as e:
-            logger.error(f"Ошибка создания пустой страницы: {e}")
-            raise
\ No newline at end of file
+# Пустая страница всегда одинакова — строим её один раз.
+_BLANK_PDF_BYTES = _build_blank_pdf_bytes()
+
+
+def create_blank_pdf() -> str:
+    """Создаёт пустую PDF-страницу формата A4."""
+    try:
+        fd, path = tempfile.mkstemp(suffix=".pdf", prefix="blank_")
+        with os.fdopen(fd, "wb") as f:
+            f.write(_BLANK_PDF_BYTES)
+        return path
+    except Exception as e:
+        logger.error(f"Ошибка создания пустой страницы: {e}")
+        raise
\ No newline at end of file
@@ -2,96 +2,247 @@
 # Обработчики сообщений и команд для Telegram-бота
 
 import os
+import asyncio
 import logging
+import multiprocessing
 import tempfile
 import shutil
 import re
 import time
+import weakref
 import pypdf
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from config import ADMIN_ID, MAX_FILE_SIZE, SUPPORTED_FORMATS, DEFAULT_SHEETS_PER_SIGNATURE, PRINTER_NAME
+from config import (
+    ADMIN_ID, MAX_FILE_SIZE, SUPPORTED_FORMATS, DEFAULT_SHEETS_PER_SIGNATURE, PRINTER_NAME, PDF_POOL_WORKERS
+)
 from utils import (
-    is_user_allowed, is_admin, get_file_extension, is_office_document,
-    is_image_file, is_text_file, load_allowed_users, save_allowed_users
+    is_admin, get_file_extension, is_supported_format, is_office_document,
+    is_image_file, is_text_file, load_allowed_users, save_allowed_users, short_err
 )
 from conversion import convert_to_pdf, convert_image_to_pdf, convert_pdf_to_grayscale, create_blank_pdf
-from printing import calculate_signature_config, create_booklet_for_short_edge, print_file_postscript
+from printing import calculate_signature_config, create_booklet_parallel, print_file_postscript
 from scanning import scan_single_page, scan_multiple_pages, convert_images_to_pdf
 
 logger = logging.getLogger(__name__)
 
+# Диапазон страниц вида 1-3,5,7-9
+_PAGE_RANGE_RE = re.compile(r'^(\d+(-\d+)?)(,\d+(-\d+)?)*$')
+
+
+def _unlink(path):
+    """Удаляет файл одним системным вызовом; отсутствующий файл или None — не ошибка."""
+    try:
+        os.unlink(path)
+    except (FileNotFoundError, TypeError):
+        pass
+
+
+def _unlink_all(*paths):
+    """Удаляет несколько файлов за один вызов — чтобы уводить очистку в поток одним to_thread."""
+    for path in paths:
+        _unlink(path)
+
+
+def _get_pdf_pool(context: ContextTypes.DEFAULT_TYPE) -> ProcessPoolExecutor:
+    """
+    Общий пул процессов для CPU-тяжёлой работы с PDF (сборка брошюр, PDF из сканов): pypdf и img2pdf держат GIL.
+    Создаётся при первом использовании и живёт в bot_data до остановки бота (закрывается в post_shutdown).
+    forkserver: рабочие процессы порождаются от маленького чистого сервера, а не форком бота с его потоками.
+    """
+    pool = context.bot_data.get('pdf_pool')
+    if pool is None:
+        pool = context.bot_data['pdf_pool'] = ProcessPoolExecutor(
+            max_workers=PDF_POOL_WORKERS, mp_context=multiprocessing.get_context('forkserver')
+        )
+    return pool
+
+
+def _drop_pdf_pool(context: ContextTypes.DEFAULT_TYPE, pool: ProcessPoolExecutor):
+    """
+    Убирает сломанный пул (рабочий процесс убит OOM-killer'ом или упал): такой пул отклоняет все новые задачи.
+    Закрываем его без ожидания и удаляем из bot_data — _get_pdf_pool создаст новый при следующем использовании.
+    """
+    if context.bot_data.get('pdf_pool') is pool:
+        del context.bot_data['pdf_pool']
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _session_lock(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> asyncio.Lock:
+    """
+    Замок сессии печати пользователя. Обновления обрабатываются параллельно (concurrent_updates),
+    поэтому всё, что читает или меняет pdf_path/page_count в user_data, выполняется под ним:
+    двойное нажатие «Печать» или новый файл посреди печати иначе работают с чужим состоянием.
+    Хранится в bot_data, а не в user_data — user_data.clear() не должен терять замок, пока его ждут.
+    Словарь слабых ссылок: замок живёт, пока его держат или ждут, затем удаляется сам.
+    """
+    locks = context.bot_data.get('session_locks')
+    if locks is None:
+        locks = context.bot_data['session_locks'] = weakref.WeakValueDictionary()
+    lock = locks.get(user_id)
+    if lock is None:
+        lock = locks[user_id] = asyncio.Lock()
+    return lock
+
+
+def _kids_page_count(pages_node) -> int:
+    """Сумма страниц непосредственных потомков узла /Pages: /Count у вложенных /Pages, 1 у /Page. -1 — счётчик битый."""
+    total = 0
+    for kid in pages_node.get('/Kids', ()):
+        kid = kid.get_object()
+        if kid.get('/Type') == '/Pages':
+            count = kid.get('/Count')
+            if not isinstance(count, int) or count < 0:
+                return -1
+            total += count
+        else:
+            total += 1
+    return total
+
+
+def _pdf_page_count(pdf_path: str) -> int:
+    """
+    Возвращает число страниц PDF (блокирующая, для run_in_executor).
+    Это единственный источник числа страниц сессии: по нему решается авто-печать,
+    показывается раскладка брошюры и собираются её сигнатуры.
+    Читает /Root /Pages /Count и сверяет его с суммой счётчиков непосредственных /Kids —
+    несколько объектов вместо обхода всего дерева; при расхождении считает страницы полным обходом.
+    """
+    with open(pdf_path, 'rb') as f:
+        reader = pypdf.PdfReader(f)
+        pages_node = reader.trailer['/Root']['/Pages']
+        count = pages_node.get('/Count')
+        if isinstance(count, int) and count > 0 and _kids_page_count(pages_node) == count:
+            return int(count)
+        return len(reader.pages)
+
+
+# Пауза перед записью allowed_users: серия /add_user и /remove_user сливается в одну запись.
+ALLOWED_USERS_SAVE_DELAY = 1.0
+
+
+async def _persist_allowed_users(bot_data: dict):
+    """
+    Сохраняет allowed_users на диск в отдельном потоке, не блокируя event loop.
+    Запись идёт под общим локом, чтобы запись по таймеру и финальная запись при остановке не пересекались.
+    """
+    async with bot_data['allowed_users_lock']:
+        snapshot = set(bot_data['allowed_users'])
+        await asyncio.to_thread(save_allowed_users, snapshot)
+
+
+async def _delayed_save_allowed_users(bot_data: dict):
+    """Пишет allowed_users не чаще раза в ALLOWED_USERS_SAVE_DELAY, пока есть несохранённые изменения."""
+    while bot_data.get('allowed_users_dirty'):
+        await asyncio.sleep(ALLOWED_USERS_SAVE_DELAY)
+        bot_data['allowed_users_dirty'] = False  # Изменения во время записи поднимут флаг снова — будет ещё круг.
+        await _persist_allowed_users(bot_data)
+
+
+def _schedule_allowed_users_save(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Вызывается после каждого изменения allowed_users: сбрасывает кеш /list_users,
+    помечает список изменённым и запускает отложенную запись, если она ещё не запланирована.
+    """
+    bot_data = context.bot_data
+    bot_data['allowed_users_dirty'] = True
+    bot_data.pop('allowed_users_sorted', None)  # Кеш для /list_users устарел.
+    task = bot_data.get('allowed_users_save_task')
+    if task is None or task.done():
+        bot_data['allowed_users_save_task'] = context.application.create_task(
+            _delayed_save_allowed_users(bot_data)
+        )
+
 
-def _build_print_mode_keyboard(is_pdf_or_office: bool) -> list:
+async def flush_allowed_users(bot_data: dict):
+    """
+    Сохраняет несохранённые изменения allowed_users (вызывается при остановке бота).
+    Отложенную запись не отменяем, а дожидаемся (не дольше ALLOWED_USERS_SAVE_DELAY + запись):
+    начатый to_thread отмене не поддаётся, и старый снимок мог бы лечь на диск поверх финального.
+    """
+    task = bot_data.pop('allowed_users_save_task', None)
+    if task and not task.done():
+        await task
+    if bot_data.pop('allowed_users_dirty', False):
+        await _persist_allowed_users(bot_data)
+
+
+# Клавиатуры статичны — строим их один раз при импорте, а не на каждый callback.
+_PRINT_MODE_FULL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📄 Обычная", callback_data="print_normal"),
+     InlineKeyboardButton("📄 Двусторонняя", callback_data="print_duplex")],
+    [InlineKeyboardButton("📖 Брошюрой", callback_data="print_booklet")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+_PRINT_MODE_IMAGE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📄 Обычная", callback_data="print_normal_only")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+_SCAN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📄 Один лист", callback_data="scan_single")],
+    [InlineKeyboardButton("📚 Несколько", callback_data="scan_multiple")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="scan_cancel")]
+])
+_START_SCAN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📸 Сканировать", callback_data="start_scan")]
+])
+_RANGE_MULTI_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Все страницы", callback_data="print_all")],
+    [InlineKeyboardButton("Свои страницы", callback_data="print_custom")],
+    [InlineKeyboardButton("Назад", callback_data="back_to_menu")]
+])
+_RANGE_SINGLE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Печатать", callback_data="print_all")],
+    [InlineKeyboardButton("Назад", callback_data="back_to_menu")]
+])
+
+
+# Приветствие /start зависит только от констант конфигурации — собираем его один раз.
+_WELCOME_TEXT = (
+    f"🤖 Бот для печати и сканирования\n\n"
+    f"📎 Отправьте файл для печати\n"
+    f"🖼️ Или фото из галереи\n"
+    f"📸 Или используйте сканер (кнопка ниже)\n\n"
+    f"⚠️ Форматы: {', '.join(sorted(SUPPORTED_FORMATS))}\n"
+    f"📏 Макс. размер: {MAX_FILE_SIZE // (1024*1024)} МБ\n\n"
+    f"📋 Особенности:\n"
+    f"Команды:\n/help_booklet - инструкция по брошюре"
+)
+_WELCOME_ADMIN_TAIL = "\n\n⚙️ Админ: /add_user, /remove_user, /list_users"
+
+
+def _build_print_mode_keyboard(is_pdf_or_office: bool) -> InlineKeyboardMarkup:
     """Возвращает клавиатуру выбора режима печати."""
-    if is_pdf_or_office:
-        return [
-            [InlineKeyboardButton("📄 Обычная", callback_data="print_normal"),
-             InlineKeyboardButton("📄 Двусторонняя", callback_data="print_duplex")],
-            [InlineKeyboardButton("📖 Брошюрой", callback_data="print_booklet")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-        ]
-    return [
-        [InlineKeyboardButton("📄 Обычная", callback_data="print_normal_only")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-    ]
-
-
-def _build_scan_keyboard() -> list:
+    return _PRINT_MODE_FULL_MARKUP if is_pdf_or_office else _PRINT_MODE_IMAGE_MARKUP
+
+
+def _build_scan_keyboard() -> InlineKeyboardMarkup:
     """Возвращает клавиатуру для сканирования."""
-    return [
-        [InlineKeyboardButton("📄 Один лист", callback_data="scan_single")],
-        [InlineKeyboardButton("📚 Несколько", callback_data="scan_multiple")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="scan_cancel")]
-    ]
+    return _SCAN_MARKUP
 
 
-def _build_page_range_keyboard(page_count: int) -> list:
+def _build_page_range_keyboard(page_count: int) -> InlineKeyboardMarkup:
     """Возвращает клавиатуру выбора диапазона страниц."""
-    keyboard = []
-    if page_count > 1:
-        keyboard += [
-            [InlineKeyboardButton("Все страницы", callback_data="print_all")],
-            [InlineKeyboardButton("Свои страницы", callback_data="print_custom")]
-        ]
-    else:
-        keyboard += [[InlineKeyboardButton("Печатать", callback_data="print_all")]]
-    keyboard += [[InlineKeyboardButton("Назад", callback_data="back_to_menu")]]
-    return keyboard
+    return _RANGE_MULTI_MARKUP if page_count > 1 else _RANGE_SINGLE_MARKUP
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    allowed_users = context.bot_data.get('allowed_users', set())
-
-    if not is_user_allowed(user_id, allowed_users):
+    if user_id != ADMIN_ID and user_id not in context.bot_data['allowed_users']:
         await update.message.reply_text("❌ Доступ запрещен. Обратитесь к администратору.")
         return
 
-    keyboard = [[InlineKeyboardButton("📸 Сканировать", callback_data="start_scan")]]
-    welcome_text = (
-        f"🤖 Бот для печати и сканирования\n\n"
-        f"📎 Отправьте файл для печати\n"
-        f"🖼️ Или фото из галереи\n"
-        f"📸 Или используйте сканер (кнопка ниже)\n\n"
-        f"⚠️ Форматы: {', '.join(sorted(SUPPORTED_FORMATS))}\n"
-        f"📏 Макс. размер: {MAX_FILE_SIZE // (1024*1024)} МБ\n\n"
-        f"📋 Особенности:\n"
-        f"Команды:\n/help_booklet - инструкция по брошюре"
-    )
-    if is_admin(user_id):
-        welcome_text += "\n\n⚙️ Админ: /add_user, /remove_user, /list_users"
-
-    await update.message.reply_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard))
+    welcome_text = _WELCOME_TEXT + (_WELCOME_ADMIN_TAIL if is_admin(user_id) else '')
+    await update.message.reply_text(welcome_text, reply_markup=_START_SCAN_MARKUP)
 
 
 async def help_booklet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    allowed_users = context.bot_data.get('allowed_users', set())
-
-    if not is_user_allowed(user_id, allowed_users):
+    if user_id != ADMIN_ID and user_id not in context.bot_data['allowed_users']:
         await update.message.reply_text("❌ Доступ запрещен")
         return
 
@@ -124,8 +275,8 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         allowed_users.add(new_user_id)
-        save_allowed_users(allowed_users)
-        context.bot_data['allowed_users'] = allowed_users
+        # Запись на диск — отложенная и общая для серии изменений: ответ админу не ждёт файловой операции.
+        _schedule_allowed_users_save(context)
 
         await update.message.reply_text(f"✅ Добавлен {new_user_id}")
         logger.info(f"Админ {user_id} добавил {new_user_id}")
@@ -157,8 +308,8 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         allowed_users.remove(remove_id)
-        save_allowed_users(allowed_users)
-        context.bot_data['allowed_users'] = allowed_users
+        # Запись на диск — отложенная и общая для серии изменений: ответ админу не ждёт файловой операции.
+        _schedule_allowed_users_save(context)
 
         await update.message.reply_text(f"✅ Удален {remove_id}")
         logger.info(f"Админ {user_id} удалил {remove_id}")
@@ -174,25 +325,27 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Только для админа")
         return
 
-    allowed_users = context.bot_data.get('allowed_users', set())
+    allowed_users = context.bot_data['allowed_users']
     if not allowed_users:
         await update.message.reply_text("📋 Список пуст")
         return
 
-    users_list = "📋 Пользователи:\n\n"
-    for uid in sorted(allowed_users):
-        role = "👑 (админ)" if uid == ADMIN_ID else "👤"
-        users_list += f"{role} {uid}\n"
-    users_list += f"\nВсего: {len(allowed_users)}"
+    # Отсортированный список кешируется до следующего /add_user или /remove_user.
+    sorted_users = context.bot_data.get('allowed_users_sorted')
+    if sorted_users is None:
+        sorted_users = context.bot_data['allowed_users_sorted'] = tuple(sorted(allowed_users))
+
+    lines = ["📋 Пользователи:", ""]
+    lines.extend(f"{'👑 (админ)' if uid == ADMIN_ID else '👤'} {uid}" for uid in sorted_users)
+    lines.append("")
+    lines.append(f"Всего: {len(allowed_users)}")
 
-    await update.message.reply_text(users_list)
+    await update.message.reply_text("\n".join(lines))
 
 
 async def handle_document_or_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    allowed_users = context.bot_data.get('allowed_users', set())
-
-    if not is_user_allowed(user_id, allowed_users):
+    if user_id != ADMIN_ID and user_id not in context.bot_data['allowed_users']:
         await update.message.reply_text("❌ Доступ запрещен")
         return
 
@@ -206,9 +359,9 @@ async def handle_document_or_photo(update: Update, context: ContextTypes.DEFAULT
         return
 
     file_name = document.file_name if document else f"photo_{photo.file_id}.jpg"
-    file_ext = get_file_extension(file_name).lower()
+    file_ext = get_file_extension(file_name)
 
-    if file_obj.file_size > MAX_FILE_SIZE or file_ext not in SUPPORTED_FORMATS:
+    if file_obj.file_size > MAX_FILE_SIZE or not is_supported_format(file_ext):
         await message.reply_text("❌ Файл слишком большой или формат не поддерживается")
         return
 
@@ -216,65 +369,72 @@ async def handle_document_or_photo(update: Update, context: ContextTypes.DEFAULT
 
     temp_file_path = None
     pdf_path = None
+    is_pdf = file_ext == '.pdf'
+    is_office = is_office_document(file_ext)
+    is_image = is_image_file(file_ext)
 
     try:
         file = await file_obj.get_file()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp:
-            await file.download_to_drive(tmp.name)
-            temp_file_path = tmp.name
-
-        if file_ext == '.pdf':
-            pdf_path = await convert_pdf_to_grayscale(update, context, temp_file_path)
-        elif is_office_document(file_ext):
-            pdf_path = await convert_to_pdf(update, context, temp_file_path, file_ext, grayscale=True)
-        elif is_image_file(file_ext):
-            pdf_path = await convert_image_to_pdf(update, context, temp_file_path, grayscale=True)
-        else:
-            await message.reply_text("❌ Формат не поддерживается для конвертации")
-            return
-
-        with open(pdf_path, 'rb') as f:
-            reader = pypdf.PdfReader(f)
-            page_count = len(reader.pages)
-
-        context.user_data.update({
-            'pdf_path': pdf_path,
-            'file_name': file_name,
-            'page_count': page_count,
-            'is_pdf': file_ext == '.pdf',
-            'is_office': is_office_document(file_ext),
-            'is_image': is_image_file(file_ext),
-            'awaiting_custom_range': False,
-            'print_mode': 'normal'
-        })
-
-        if page_count == 1:
-            await message.reply_text("🖨️ Авто-печать 1 страницы (grayscale)...")
-            success = print_file_postscript(pdf_path, printer_name=PRINTER_NAME)
-            if os.path.exists(pdf_path):
-                os.unlink(pdf_path)
-            context.user_data.clear()
-            await message.reply_text("✅ Отправлено на печать" if success else "❌ Ошибка печати")
-            return
-
-        is_pdf_or_office = context.user_data['is_pdf'] or context.user_data['is_office']
-        keyboard = _build_print_mode_keyboard(is_pdf_or_office)
-
-        await message.reply_text(
-            f"✅ Файл готов: {file_name}\nСтраниц: {page_count}\nВыберите режим печати:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        # Создание файла на медленном диске (SD-карта, NFS) не должно останавливать event loop.
+        fd, temp_file_path = await asyncio.to_thread(tempfile.mkstemp, suffix=file_ext)
+        os.close(fd)
+        await file.download_to_drive(temp_file_path)
+
+        # Одна временная директория на всё задание: шаги конвертации работают в её подкаталогах.
+        # Создаётся и удаляется в потоке — как и остальные временные файлы, не на event loop.
+        job_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="job_")
+        try:
+            if is_pdf:
+                pdf_path = await convert_pdf_to_grayscale(update, context, temp_file_path, workdir=job_dir)
+            elif is_office:
+                pdf_path = await convert_to_pdf(update, context, temp_file_path, file_ext, grayscale=True, workdir=job_dir)
+            elif is_image:
+                pdf_path = await convert_image_to_pdf(update, context, temp_file_path, grayscale=True, workdir=job_dir)
+            else:
+                await message.reply_text("❌ Формат не поддерживается для конвертации")
+                return
+        finally:
+            await asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True)
+
+        # Разбор PDF — CPU-работа, уводим её с event loop.
+        page_count = await asyncio.get_running_loop().run_in_executor(None, _pdf_page_count, pdf_path)
+
+        async with _session_lock(context, user_id):
+            ud = context.user_data
+            # Файл прошлой сессии, так и не отправленный на печать, больше никому не нужен.
+            if ud.get('pdf_path') not in (None, pdf_path):
+                await asyncio.to_thread(_unlink, ud['pdf_path'])
+            ud.clear()
+            ud['pdf_path'] = pdf_path
+            ud['file_name'] = file_name
+            ud['page_count'] = page_count
+            ud['is_pdf'] = is_pdf
+            ud['is_office'] = is_office
+            ud['is_image'] = is_image
+            ud['awaiting_custom_range'] = False
+            ud['print_mode'] = 'normal'
+
+            if page_count == 1:
+                await message.reply_text("🖨️ Авто-печать 1 страницы (grayscale)...")
+                success = await print_file_postscript(pdf_path, printer_name=PRINTER_NAME)
+                await asyncio.to_thread(_unlink, pdf_path)
+                ud.clear()
+                await message.reply_text("✅ Отправлено на печать" if success else "❌ Ошибка печати")
+                return
+
+            keyboard = _build_print_mode_keyboard(is_pdf or is_office)
+
+            await message.reply_text(
+                f"✅ Файл готов: {file_name}\nСтраниц: {page_count}\nВыберите режим печати:",
+                reply_markup=keyboard
+            )
 
     except Exception as e:
         logger.error(f"Ошибка обработки файла от {user_id}: {e}", exc_info=True)
-        await message.reply_text(f"❌ Ошибка обработки: {str(e)[:120]}\nПопробуйте другой файл.")
+        await message.reply_text(f"❌ Ошибка обработки: {short_err(e)}\nПопробуйте другой файл.")
     
     finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.unlink(temp_file_path)
-            except:
-                pass
+        await asyncio.to_thread(_unlink, temp_file_path)
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -291,7 +451,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• Один лист — на планшет\n"
             "• Несколько — через автоподатчик\n"
             "⚠️ 600dpi может занять время!",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=keyboard
         )
         return
 
@@ -299,32 +459,36 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_scan_callback(update, context)
         return
 
-    if 'pdf_path' not in context.user_data:
+    async with _session_lock(context, user_id):
+        await _handle_print_callback(query, context, data)
+
+
+async def _handle_print_callback(query, context: ContextTypes.DEFAULT_TYPE, data: str):
+    """Кнопки режима печати и диапазона страниц. Вызывается под _session_lock пользователя."""
+    ud = context.user_data
+    if 'pdf_path' not in ud:
         await query.edit_message_text("❌ Сессия истекла или файл не найден")
         return
 
-    pdf_path = context.user_data['pdf_path']
-    page_count = context.user_data.get('page_count', 0)
-    file_name = context.user_data.get('file_name', 'file')
+    # Снимок состояния один раз — дальше ветки работают только с локальными переменными.
+    pdf_path, page_count, file_name = ud['pdf_path'], ud.get('page_count', 0), ud.get('file_name', 'file')
 
     if data == "cancel":
-        if os.path.exists(pdf_path):
-            os.unlink(pdf_path)
-        context.user_data.clear()
+        await asyncio.to_thread(_unlink, pdf_path)
+        ud.clear()
         await query.edit_message_text("❌ Операция отменена")
         return
 
     if data == "print_normal_only":
         await query.edit_message_text("🖨️ Печатаю односторонне...")
-        success = print_file_postscript(pdf_path, printer_name=PRINTER_NAME)
-        if os.path.exists(pdf_path):
-            os.unlink(pdf_path)
-        context.user_data.clear()
+        success = await print_file_postscript(pdf_path, printer_name=PRINTER_NAME)
+        await asyncio.to_thread(_unlink, pdf_path)
+        ud.clear()
         await query.edit_message_text("✅ Отправлено" if success else "❌ Ошибка печати")
         return
 
     if data in ["print_normal", "print_duplex"]:
-        context.user_data['print_mode'] = 'normal' if data == "print_normal" else 'duplex'
+        ud['print_mode'] = 'normal' if data == "print_normal" else 'duplex'
 
         if page_count <= 1:
             await execute_print_with_range(context, query.edit_message_text)
@@ -335,17 +499,17 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mode_text = "Обычная" if data == "print_normal" else "Двусторонняя"
         await query.edit_message_text(
             f"📄 {mode_text} печать\nФайл: {file_name}\nСтраниц: {page_count}\nВыберите диапазон:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=keyboard
         )
         return
 
     if data == "print_booklet":
-        context.user_data['print_mode'] = 'booklet'
+        ud['print_mode'] = 'booklet'
         if page_count < 2:
             keyboard = _build_print_mode_keyboard(True)
             await query.edit_message_text(
                 f"❌ Для брошюры минимум 2 страницы\nФайл: {file_name}\nСтраниц: {page_count}\nРежим:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
             return
 
@@ -364,20 +528,27 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(info_text)
 
         try:
-            booklet_files = create_booklet_for_short_edge(pdf_path, sheets_per_sig, page_count)
+            # Сборка брошюры тяжёлая по CPU — сигнатуры собираются параллельно в общем пуле процессов.
+            pool = _get_pdf_pool(context)
+            try:
+                # Воркерам передаётся только путь: каждый сам открывает PDF, содержимое не копируется через pickle.
+                booklet_files = await create_booklet_parallel(pdf_path, sheets_per_sig, page_count, pool)
+            except BrokenProcessPool:
+                _drop_pdf_pool(context, pool)
+                raise
             if not booklet_files:
                 raise Exception("Не удалось создать файлы брошюры")
 
-            success = all(
-                print_file_postscript(f, booklet=True, duplex=True, printer_name=PRINTER_NAME)
-                for f in booklet_files
-            )
+            # Сигнатуры отправляем строго по очереди: порядок заданий в CUPS = порядок листов в брошюре.
+            success = True
+            for f in booklet_files:
+                if not await print_file_postscript(f, booklet=True, duplex=True, printer_name=PRINTER_NAME):
+                    success = False
+                    break
 
-            for f in booklet_files + [pdf_path]:
-                if os.path.exists(f):
-                    os.unlink(f)
+            await asyncio.to_thread(_unlink_all, pdf_path, *booklet_files)
 
-            context.user_data.clear()
+            ud.clear()
             await query.edit_message_text(
                 f"✅ Брошюра отправлена на печать\n"
                 f"Сигнатур: {num_signatures}\nЛистов: {sheets_with_blanks}"
@@ -385,28 +556,27 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         except Exception as e:
             logger.error(f"Ошибка брошюры: {e}", exc_info=True)
-            if os.path.exists(pdf_path):
-                os.unlink(pdf_path)
-            context.user_data.clear()
-            await query.edit_message_text(f"❌ Ошибка: {str(e)[:120]}")
+            await asyncio.to_thread(_unlink, pdf_path)
+            ud.clear()
+            await query.edit_message_text(f"❌ Ошибка: {short_err(e)}")
             return
 
     elif data == "print_all":
         await execute_print_with_range(context, query.edit_message_text)
 
     elif data == "print_custom":
-        context.user_data['awaiting_custom_range'] = True
+        ud['awaiting_custom_range'] = True
         await query.edit_message_text("📝 Введите диапазон страниц (пример: 1-3,5,7-9)\nИли /cancel")
 
     elif data == "back_to_menu":
-        context.user_data['awaiting_custom_range'] = False
+        ud['awaiting_custom_range'] = False
 
-        is_pdf_or_office = context.user_data.get('is_pdf', False) or context.user_data.get('is_office', False)
+        is_pdf_or_office = ud.get('is_pdf', False) or ud.get('is_office', False)
         keyboard = _build_print_mode_keyboard(is_pdf_or_office)
 
         await query.edit_message_text(
             f"✅ Файл: {file_name}\nСтраниц: {page_count}\nВыберите режим:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=keyboard
         )
 
 
@@ -427,7 +597,7 @@ async def execute_print_with_range(context: ContextTypes.DEFAULT_TYPE, reply_fun
     msg = "🖨️ Печатаю двусторонне..." if duplex else "🖨️ Печатаю односторонне..."
     await reply_func(msg)
 
-    success = print_file_postscript(
+    success = await print_file_postscript(
         pdf_path,
         duplex=duplex,
         page_range=page_range,
@@ -435,14 +605,19 @@ async def execute_print_with_range(context: ContextTypes.DEFAULT_TYPE, reply_fun
     )
 
     range_text = f" (страницы: {page_range})" if page_range else " (все страницы)"
-    if os.path.exists(pdf_path):
-        os.unlink(pdf_path)
+    await asyncio.to_thread(_unlink, pdf_path)
 
     context.user_data.clear()
     await reply_func(f"✅ Отправлено{range_text}" if success else "❌ Ошибка печати")
 
 
 async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with _session_lock(context, update.effective_user.id):
+        await _handle_custom_range(update, context)
+
+
+async def _handle_custom_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ввод своего диапазона страниц. Вызывается под _session_lock пользователя."""
     if 'awaiting_custom_range' not in context.user_data or not context.user_data['awaiting_custom_range']:
         return
 
@@ -453,10 +628,10 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         keyboard = _build_page_range_keyboard(page_count)
 
-        await update.message.reply_text("❌ Ввод отменён\nВыберите страницы:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text("❌ Ввод отменён\nВыберите страницы:", reply_markup=keyboard)
         return
 
-    if not re.match(r'^(\d+(-\d+)?)(,\d+(-\d+)?)*$', text):
+    if not _PAGE_RANGE_RE.match(text):
         await update.message.reply_text("❌ Неверный формат. Пример: 1-3,5,7-9\nИли /cancel")
         return
 
@@ -469,17 +644,15 @@ async def handle_scan_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
 
     user_id = query.from_user.id
-    allowed_users = context.bot_data.get('allowed_users', set())
-
-    if not is_user_allowed(user_id, allowed_users):
+    if user_id != ADMIN_ID and user_id not in context.bot_data['allowed_users']:
         await query.edit_message_text("❌ Доступ запрещен")
         return
 
     data = query.data
     if data == "scan_cancel":
-        keyboard = [[InlineKeyboardButton("📸 Сканировать", callback_data="start_scan")]]
+        keyboard = _START_SCAN_MARKUP
 
-        await query.edit_message_text("❌ Сканирование отменено", reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text("❌ Сканирование отменено", reply_markup=keyboard)
         return
 
     await query.edit_message_text("🔄 Подготовка сканера...")
@@ -495,7 +668,14 @@ async def handle_scan_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
         if scanned_files:
             await query.edit_message_text(f"🔄 Объединяю {len(scanned_files)} стр. в PDF...")
-            pdf_path = await convert_images_to_pdf(scanned_files)
+            pool = _get_pdf_pool(context)
+            try:
+                pdf_path = await convert_images_to_pdf(scanned_files, pool)
+            except BrokenProcessPool:
+                # Сканы уже на диске — не теряем их: пул пересоздаём, а этот PDF собираем в потоке.
+                logger.warning("Пул процессов сломан, собираю PDF из сканов в потоке")
+                _drop_pdf_pool(context, pool)
+                pdf_path = await convert_images_to_pdf(scanned_files)
 
             await query.edit_message_text(f"✅ Готово! Отправляю PDF ({len(scanned_files)} стр.)")
 
@@ -507,14 +687,12 @@ async def handle_scan_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                     caption=f"Сканирование ({len(scanned_files)} стр., 600dpi Lineart)"
                 )
 
-            for f in scanned_files + [pdf_path]:
-                if os.path.exists(f):
-                    os.unlink(f)
+            await asyncio.to_thread(_unlink_all, pdf_path, *scanned_files)
 
             keyboard = _build_scan_keyboard()
             await query.edit_message_text(
                 "📸 Готов к новому сканированию",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
         else:
             await query.edit_message_text("❌ Не удалось отсканировать ни одной страницы")
@@ -531,7 +709,7 @@ async def handle_scan_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         keyboard = _build_scan_keyboard()
         await query.edit_message_text(
             f"❌ Ошибка сканирования: {error_msg}\n\nПопробуйте снова:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=keyboard
         )
 
 
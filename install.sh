@@ -27,12 +27,13 @@ check_command python3
 check_command scanimage
 check_command lp
 check_command soffice
+check_command unoconv
 check_command gs
 
 if [ $missing_dependencies -ne 0 ]; then
     echo -e "${YELLOW}⚠️  Некоторые системные утилиты отсутствуют. Бот может работать не полностью.${NC}"
     echo "Для установки на Debian/Ubuntu выполните:"
-    echo "sudo apt update && sudo apt install -y python3-venv sane-utils cups libreoffice-writer-nogui ghostscript"
+    echo "sudo apt update && sudo apt install -y python3-venv sane-utils cups libreoffice-writer-nogui unoconv ghostscript"
 fi
 
 echo -e "\n${GREEN}📦 Настройка Python окружения...${NC}"
@@ -67,9 +68,11 @@ if [ ! -f "$PROJECT_DIR/.env" ]; then
 BOT_TOKEN=ваш_токен_здесь
 ADMIN_ID=ваш_id
 PRINTER_NAME=Xerox_WorkCentre_3220
-SCANNER_DEVICE=xerox_mfp:libusb:001:004
+SCANNER_DEVICE=auto
 DEFAULT_SHEETS=5
 DEFAULT_COPIES=1
+# MAX_CONCURRENT_CONVERSIONS=2
+# SCANNER_WARMUP_INTERVAL=0
 EOF
     echo -e "${YELLOW}👉 Создайте .env на основе .env.example и укажите BOT_TOKEN!${NC}"
 else
@@ -2,18 +2,20 @@
 # Этот файл содержит функции для печати и создания брошюр.
 
 import os
-import subprocess
+import asyncio
+import functools
 import math
 import logging
-import re
 import pypdf  # Импорт pypdf.
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject
 import tempfile  # Импорт tempfile.
 import time  # Импорт time.
-
-from utils import create_temp_copy  # Импорт из utils.
+from concurrent.futures.process import BrokenProcessPool
 
 logger = logging.getLogger(__name__)  # Логгер.
 
+_PAGE_RANGE_CHARS = frozenset('0123456789,-')  # Допустимые символы page_range для lp.
+
 def calculate_signature_config(page_count: int, default_sheets: int = 5) -> tuple:  # Функция рассчитывает конфигурацию для брошюры, возвращает кортеж (tuple - неизменяемый список).
     """Рассчитывает конфигурацию сигнатур для брошюры."""  # Docstring.
     total_sheets = math.ceil(page_count / 4)  # Вычисляем общее количество листов: ceil округляет вверх (импорт math).
@@ -27,70 +29,144 @@ def calculate_signature_config(page_count: int, default_sheets: int = 5) -> tupl
         total_sheets_with_blanks = sheets_per_signature * num_signatures
     return num_signatures, sheets_per_signature, total_sheets, total_sheets_with_blanks  # Возвращаем кортеж.
 
-def create_booklet_for_short_edge(input_pdf: str, sheets_per_signature: int, total_pages_in_doc: int) -> list[str]:
-    """Создаёт PDF-брошюру для two-sided-short-edge."""
-    with tempfile.TemporaryDirectory(prefix="booklet_") as tmpdir:
-        output_files = []
-        try:
-            reader = pypdf.PdfReader(input_pdf)
-            num_pages = len(reader.pages)
-            pages_per_sig = sheets_per_signature * 4
+def _page_as_form_xobject(writer: pypdf.PdfWriter, page: pypdf.PageObject):
+    """
+    Превращает страницу в Form XObject внутри writer и возвращает ссылку на него.
+    Поток содержимого копируется как есть (без разбора и переименования ресурсов, как в merge_*),
+    общие ресурсы (шрифты) клонируются в writer один раз.
+    """
+    form = DecodedStreamObject()
+    contents = page.get_contents()
+    form.set_data(contents.get_data() if contents is not None else b"")
+    resources = page.get("/Resources")
+    form.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): ArrayObject([FloatObject(float(v)) for v in page.mediabox]),
+        NameObject("/Resources"): resources.get_object().clone(writer) if resources is not None else DictionaryObject(),
+    })
+    return writer._add_object(form)
+
+def _add_imposed_page(writer: pypdf.PdfWriter, width: float, height: float, left_ref, right_ref):
+    """Добавляет лист брошюры: левая полоса со сдвигом (10, 15), правая — (width + 30, 15). None — пустая полоса."""
+    new_page = writer.add_blank_page(width=width * 2 + 40, height=height + 30)
+    xobjects = DictionaryObject()
+    ops = []
+    for name, ref, tx in (("/L", left_ref, 10), ("/R", right_ref, width + 30)):
+        if ref is None:
+            continue
+        xobjects[NameObject(name)] = ref
+        ops.append(f"q 1 0 0 1 {tx:g} 15 cm {name} Do Q")
+    new_page[NameObject("/Resources")] = DictionaryObject({NameObject("/XObject"): xobjects})
+    content = DecodedStreamObject()
+    content.set_data("\n".join(ops).encode())
+    new_page[NameObject("/Contents")] = writer._add_object(content)
+
+def _signature_configs(num_pages: int, sheets_per_signature: int) -> list[dict]:
+    """Разбивает документ на сигнатуры: диапазоны страниц и число пустых страниц-добивок."""
+    pages_per_sig = sheets_per_signature * 4
+    current_page = 0
+    signature_configs = []
+    while current_page < num_pages:
+        end_page = min(current_page + pages_per_sig, num_pages)
+        actual_pages = end_page - current_page
+        empty_pages = pages_per_sig - actual_pages
+        signature_configs.append({
+            'start': current_page,
+            'end': end_page,
+            'total_pages_needed': pages_per_sig,
+            'actual_pages': actual_pages,
+            'sheets': sheets_per_signature,
+            'empty_pages': empty_pages
+        })
+        current_page = end_page
+    return signature_configs
+
+@functools.lru_cache(maxsize=16)
+def _imposition(sheets_per_signature: int) -> tuple:
+    """
+    Порядок полос сигнатуры для брошюры (saddle stitch): кортеж пар (левая, правая) индексов страниц.
+    Зависит только от числа листов, поэтому считается один раз на значение.
+    """
+    total_pages = sheets_per_signature * 4
+    pairs = []
+    for i in range(total_pages // 2):
+        if i & 1:  # Нечётная сторона: левая — i, правая — с конца.
+            pairs.append((i, total_pages - i - 1))
+        else:  # Чётная сторона: левая — с конца, правая — i.
+            pairs.append((total_pages - i - 1, i))
+    return tuple(pairs)
+
+def _build_one_signature(input_pdf: str, config: dict, sig_idx: int) -> str:
+    """
+    Собирает одну сигнатуру брошюры и возвращает путь к временному PDF.
+    Самодостаточна (сама открывает input_pdf), поэтому может выполняться в отдельном процессе:
+    сигнатуры не зависят друг от друга, а PageObject'ы не нужно передавать между процессами.
+    """
+    reader = pypdf.PdfReader(input_pdf)
+    # Размер полосы берём один раз: страницы документа в практике одного формата.
+    width = float(reader.pages[0].mediabox.width)
+    height = float(reader.pages[0].mediabox.height)
 
-            # Генерируем конфигурации для всех сигнатур
-            current_page = 0
-            signature_configs = []
-            while current_page < num_pages:
-                end_page = min(current_page + pages_per_sig, num_pages)
-                actual_pages = end_page - current_page
-                empty_pages = pages_per_sig - actual_pages
-                signature_configs.append({
-                    'start': current_page,
-                    'end': end_page,
-                    'total_pages_needed': pages_per_sig,
-                    'actual_pages': actual_pages,
-                    'sheets': sheets_per_signature,
-                    'empty_pages': empty_pages
-                })
-                current_page = end_page
-            
-            for sig_idx, config in enumerate(signature_configs):  # Цикл for с enumerate (индекс + значение).
-                writer = pypdf.PdfWriter()  # Новый PdfWriter.
-                pages = [reader.pages[i] for i in range(config['start'], config['end'])]  # Список страниц (list comprehension - генератор списка).
-                for _ in range(config['empty_pages']):  # Цикл for для добавления пустых страниц (_ - игнорируемая переменная).
-                    blank_page = pypdf.PageObject.create_blank_page(width=595, height=842)  # Создаем пустую страницу.
-                    pages.append(blank_page)  # Добавляем.
-                
-                total_pages = config['total_pages_needed']  # Общее страниц.
-                booklet_pages = []  # Список для брошюры.
-                for i in range(total_pages // 2):  # Цикл for, // - целочисленное деление.
-                    if i % 2 == 0:  # Если четный (% - остаток от деления).
-                        right = i
-                        left = total_pages - i - 1
-                    else:
-                        right = total_pages - i - 1
-                        left = i
-                    booklet_pages.append((pages[left], pages[right]))  # Добавляем пару страниц.
-                
-                for page_left, page_right in booklet_pages:  # Цикл по парам.
-                    width = float(page_left.mediabox.width) if page_left else 595  # Получаем ширину, float - в float, if-else в одну строку.
-                    height = float(page_left.mediabox.height) if page_left else 842  # Аналогично высота.
-                    new_page = writer.add_blank_page(width=width * 2 + 40, height=height + 30)  # Добавляем новую страницу.
-                    if page_left:  # Если левая страница существует.
-                        new_page.merge_translated_page(page_left, tx=10, ty=15)  # Сливаем с переводом (merge_translated_page).
-                    if page_right:
-                        new_page.merge_translated_page(page_right, tx=width + 30, ty=15)  # Аналогично для правой.
-                
-                temp_path = os.path.join(tmpdir, f'booklet_{sig_idx}.pdf')  # Путь к временному PDF.
-                with open(temp_path, "wb") as f:  # Открываем на запись.
-                    writer.write(f)  # Пишем.
-                output_files.append(create_temp_copy(temp_path, '.pdf'))  # Добавляем копию в список.
-            return output_files  # Возвращаем список.
-        except Exception as e:
-            logger.error(f"Ошибка создания брошюры: {e}")
-            return []  # Возвращаем пустой список при ошибке.
+    writer = pypdf.PdfWriter()  # Новый PdfWriter.
+    # Каждая страница сигнатуры — один Form XObject; пустые страницы — None (ничего не рисуем).
+    # Конец диапазона ограничиваем реальным числом страниц: недостающие тоже становятся пустыми.
+    end = min(config['end'], len(reader.pages))
+    pages = [_page_as_form_xobject(writer, reader.pages[i]) for i in range(config['start'], end)]
+    pages.extend([None] * (config['sheets'] * 4 - len(pages)))
+
+    for left, right in _imposition(config['sheets']):
+        _add_imposed_page(writer, width, height, pages[left], pages[right])
+
+    fd, output_path = tempfile.mkstemp(suffix='.pdf', prefix=f'booklet_{sig_idx}_')
+    with os.fdopen(fd, "wb") as f:  # Пишем сразу во временный файл, без промежуточной копии.
+        writer.write(f)
+    return output_path
+
+async def create_booklet_parallel(input_pdf: str, sheets_per_signature: int, total_pages_in_doc: int, executor=None) -> list[str]:
+    """
+    Создаёт PDF-брошюру, собирая сигнатуры параллельно в executor (обычно пул процессов).
+    Порядок результата совпадает с порядком сигнатур. При ошибке сборки — пустой список;
+    BrokenProcessPool пробрасывается — вызывающий код должен заменить сломанный пул.
+    total_pages_in_doc — число страниц сессии (уже проверенное при загрузке): по нему же
+    пользователю показана раскладка, поэтому документ здесь повторно не разбирается.
+    """
+    loop = asyncio.get_running_loop()
+    configs = _signature_configs(total_pages_in_doc, sheets_per_signature)
+    results = await asyncio.gather(
+        *(loop.run_in_executor(executor, _build_one_signature, input_pdf, config, sig_idx)
+          for sig_idx, config in enumerate(configs)),
+        return_exceptions=True
+    )
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        logger.error(f"Ошибка создания брошюры: {errors[0]}")
+        for path in results:
+            if isinstance(path, str):
+                os.unlink(path)
+        broken = [e for e in errors if isinstance(e, BrokenProcessPool)]
+        if broken:
+            raise broken[0]
+        return []
+    return results
+
+async def _run_lp(cmd: list[str], timeout: float) -> tuple[int, str]:
+    """Асинхронно запускает lp, не блокируя event loop. Возвращает (код возврата, stderr)."""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stderr.decode(errors='replace')
 
-def print_file_postscript(file_path: str, booklet: bool = False, duplex: bool = False, page_range: str = None, printer_name: str = 'Xerox_WorkCentre_3220') -> bool:  # Функция печати.
-    """Отправляет файл на печать через lp (CUPS)."""  # Docstring.
+async def print_file_postscript(file_path: str, booklet: bool = False, duplex: bool = False, page_range: str = None, printer_name: str = 'Xerox_WorkCentre_3220') -> bool:  # Функция печати.
+    """Отправляет файл на печать через lp (CUPS). Асинхронно."""  # Docstring.
     try:
         start_time = time.time()  # Запоминаем текущее время для расчета длительности.
         cmd = ['lp', '-d', printer_name, '-o', 'PageSize=A4']  # Базовая команда lp.
@@ -119,27 +195,27 @@ def print_file_postscript(file_path: str, booklet: bool = False, duplex: bool =
         
         if page_range:
             # Валидация page_range: допускаем только цифры, дефисы и запятые
-            if not re.match(r'^[\d,\-]+$', page_range):
+            if not set(page_range) <= _PAGE_RANGE_CHARS:
                 logger.error(f"Невалидный page_range: {page_range}")
                 return False
             cmd.extend(['-o', f'page-ranges={page_range}'])
         
         cmd.append(file_path)  # Добавляем путь к файлу в конец.
         logger.info(f"Команда печати: {' '.join(cmd)}")  # Логируем команду (' '.join - объединяет список в строку через пробел).
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)  # Запускаем.
+        returncode, stderr = await _run_lp(cmd, timeout=120)  # Запускаем.
         duration = time.time() - start_time  # Вычисляем длительность.
         
-        if result.returncode == 0:  # Если успех.
+        if returncode == 0:  # Если успех.
             logger.info(f"Печать отправлена за {duration:.1f} сек")  # Логируем с форматированием (.1f - один знак после точки).
             return True
         else:
-            logger.error(f"Ошибка печати: {result.stderr}")
+            logger.error(f"Ошибка печати: {stderr}")
             # Попытка упрощенной печати
             logger.info("Пробую упрощенную печать...")
             simple_cmd = ['lp', '-d', printer_name, '-o', 'PageSize=A4', '-o', 'fit-to-page', file_path]  # Упрощенная команда.
-            simple_result = subprocess.run(simple_cmd, capture_output=True, text=True, timeout=60)
-            return simple_result.returncode == 0  # Возвращаем True если успех.
-    except subprocess.TimeoutExpired:
+            simple_returncode, _stderr = await _run_lp(simple_cmd, timeout=60)
+            return simple_returncode == 0  # Возвращаем True если успех.
+    except asyncio.TimeoutError:
         logger.error("Таймаут печати")
         return False
     except Exception as e:
@@ -3,49 +3,301 @@
 # Все subprocess-вызовы — асинхронные, чтобы не блокировать event loop бота.
 
 import os
+import functools
+import shutil
 import subprocess
 import asyncio
 import tempfile
 import logging
 import re
-import sys
+import selectors
+from contextlib import asynccontextmanager
+import signal
+import time
+from typing import Optional
 
-from config import SCANNER_DEVICE, SCAN_OPTIONS
+import img2pdf
+import pypdf
+
+from config import SCANNER_DEVICE, SCAN_AUTODETECT, SCAN_OPTIONS, PDF_POOL_WORKERS, SCANNER_WARMUP_INTERVAL
 from utils import create_temp_copy
 
 logger = logging.getLogger(__name__)
 
+SCAN_KILL_GRACE = 2.0  # сек на завершение после SIGTERM/SIGKILL при таймауте
+# Расширение файлов скана — по формату scanimage (tiff -> .tiff).
+_SCAN_EXT = '.' + SCAN_OPTIONS['format']
+# С какого числа страниц сборку PDF из сканов выгоднее делить между процессами пула.
+PARALLEL_PDF_MIN_PAGES = 8
+
+# Кеш автоопределения сканера: scanimage -L перебирает шину и занимает секунды.
+SCANNER_CACHE_TTL = 300.0  # сек
+_scanner_cache: Optional[tuple[str, float]] = None  # (устройство, время определения по monotonic)
+_scanner_lock: Optional[asyncio.Lock] = None  # Создаётся лениво — см. _get_scanner_lock.
+# Ошибки SANE, после которых сохранённое устройство могло устареть (переподключение, смена порта).
+_STALE_DEVICE_ERRORS = ('device busy', 'invalid argument')
+_DEVICE_RE = re.compile(r"device\s+`([^']+)'")  # Запасной разбор вывода scanimage -L.
+
+# Прогрев не должен открывать устройство, пока идёт настоящий скан, и наоборот.
+_active_scans = 0
+_warmup_lock: Optional[asyncio.Lock] = None  # Создаётся лениво — см. _get_warmup_lock.
+
+
+def _get_scanner_lock() -> asyncio.Lock:
+    """
+    Лок автоопределения, создаётся при первом использовании внутри работающего event loop:
+    на Python 3.9 asyncio.Lock, созданный при импорте, привязан к циклу, который был до uvloop.
+    """
+    global _scanner_lock
+    if _scanner_lock is None:
+        _scanner_lock = asyncio.Lock()
+    return _scanner_lock
+
+
+def _get_warmup_lock() -> asyncio.Lock:
+    """Лок прогрева; как и _get_scanner_lock, создаётся внутри работающего event loop."""
+    global _warmup_lock
+    if _warmup_lock is None:
+        _warmup_lock = asyncio.Lock()
+    return _warmup_lock
+
+
+def invalidate_scanner_cache():
+    """Сбрасывает кеш автоопределения — следующий скан заново вызовет scanimage -L."""
+    global _scanner_cache
+    _scanner_cache = None
+
+
+def _check_scan_error(error_text: str):
+    """Сбрасывает кеш сканера, если ошибка говорит о том, что устройство изменилось."""
+    lowered = error_text.lower()
+    if any(marker in lowered for marker in _STALE_DEVICE_ERRORS):
+        logger.info("Сбрасываю кеш сканера после ошибки устройства")
+        invalidate_scanner_cache()
+
+
+def _exclusive_of_warmup(func):
+    """
+    Декоратор для функций сканирования: пока скан идёт, прогрев пропускается,
+    а начатый прогрев скан дожидается (scanimage -n держит устройство недолго).
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        global _active_scans
+        _active_scans += 1
+        try:
+            async with _get_warmup_lock():
+                pass
+            return await func(*args, **kwargs)
+        finally:
+            _active_scans -= 1
+    return wrapper
+
+
+async def warmup_scanner(interval: float = SCANNER_WARMUP_INTERVAL):
+    """
+    Фоновая задача: периодически открывает сканер без сканирования (scanimage -n).
+    SANE после простоя заново инициализирует USB-устройство, и без прогрева эти секунды
+    достаются первому пользователю. Заодно обновляется кеш автоопределения.
+    """
+    if interval <= 0 or not shutil.which('scanimage'):
+        return
+    while True:
+        if not _active_scans:
+            async with _get_warmup_lock():
+                if not _active_scans:
+                    try:
+                        device = await auto_detect_scanner()
+                        _stdout, _stderr, returncode = await _run_scan_command(
+                            ['scanimage', '-d', device, '-n'], timeout=10.0, description="прогрев сканера",
+                            capture_stdout=False, capture_stderr=False
+                        )
+                        if returncode != 0:
+                            invalidate_scanner_cache()  # Устройство могло смениться — при следующем круге определим заново.
+                    except Exception as e:
+                        logger.warning(f"Прогрев сканера не удался: {e}")
+        await asyncio.sleep(interval)
+
+
+def _kill_process_group(process: subprocess.Popen):
+    """
+    Останавливает зависшую команду вместе с её потомками: SIGTERM группе, затем SIGKILL.
+    Каждое ожидание ограничено SCAN_KILL_GRACE — зависший USB-сканер не должен подвесить поток навсегда.
+    Ждём через communicate(), чтобы дочитать pipe и не упереться в заполненный буфер.
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.communicate(timeout=SCAN_KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+    logger.warning(f"Процесс {process.pid} не завершился после SIGKILL")
+
+
+def _signal_process_group(process: subprocess.Popen, sig: int):
+    """Неблокирующий сигнал группе процессов команды (для отмены из event loop); завершившаяся команда — не ошибка."""
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _communicate_lines(process: subprocess.Popen, timeout: float, on_stdout_line) -> bytes:
+    """
+    Как communicate(), но stdout отдаётся построчно в on_stdout_line по мере появления строк.
+    Возвращает stderr. При превышении timeout бросает subprocess.TimeoutExpired.
+    """
+    deadline = time.monotonic() + timeout
+    stderr_chunks = []
+    pending = b''
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ)
+        if process.stderr is not None:
+            selector.register(process.stderr, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            for key, _events in selector.select(remaining):
+                data = os.read(key.fd, 32768)
+                if not data:
+                    selector.unregister(key.fileobj)
+                elif key.fileobj is process.stderr:
+                    stderr_chunks.append(data)
+                else:
+                    *lines, pending = (pending + data).split(b'\n')
+                    for line in lines:
+                        on_stdout_line(line.decode(errors='replace').strip())
+    if pending:
+        on_stdout_line(pending.decode(errors='replace').strip())
+    process.wait(timeout=max(deadline - time.monotonic(), 0))
+    return b''.join(stderr_chunks)
+
+
+def _run_command_blocking(
+    cmd: list[str], timeout: float, on_stdout_line=None,
+    capture_stdout: bool = True, capture_stderr: bool = True, state: Optional[dict] = None
+) -> Optional[tuple[bytes, bytes, int]]:
+    """
+    Запускает команду и ждёт её завершения (блокирующая, для asyncio.to_thread).
+    Возвращает (stdout, stderr, код возврата) или None при таймауте (группа процессов к этому моменту остановлена).
+    Команда запускается в собственной сессии (setsid), чтобы при таймауте убить и её потомков.
+    Если задан on_stdout_line, stdout не накапливается, а отдаётся ему построчно (stdout в результате — b'').
+    capture_stdout / capture_stderr = False — поток уходит в DEVNULL (в результате b''):
+    не заводим pipe, если вывод никто не читает.
+    state (необязательно) — общий с корутиной словарь: сюда кладётся process, чтобы отмена
+    задачи могла остановить команду; если отмена пришла раньше запуска — команда сразу останавливается.
+    """
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE if capture_stdout or on_stdout_line else subprocess.DEVNULL,
+        stderr=subprocess.PIPE if capture_stderr else subprocess.DEVNULL,
+        start_new_session=True
+    )
+    try:
+        if state is not None:
+            state['process'] = process
+            if state.get('cancelled'):
+                _kill_process_group(process)
+                return None
+        if on_stdout_line is None:
+            stdout, stderr = process.communicate(timeout=timeout)
+        else:
+            stdout, stderr = b'', _communicate_lines(process, timeout, on_stdout_line)
+        return stdout or b'', stderr or b'', process.returncode
+    except subprocess.TimeoutExpired:
+        _kill_process_group(process)
+        return None
+    except BaseException:
+        _kill_process_group(process)  # Ошибка в on_stdout_line — не оставляем сканер работать вхолостую.
+        raise
+    finally:
+        for pipe in (process.stdout, process.stderr):
+            if pipe is not None:
+                pipe.close()
+
 
 async def _run_scan_command(
     cmd: list[str],
     timeout: float = 120.0,
-    description: str = "сканирование"
-) -> tuple[bytes, bytes]:
+    description: str = "сканирование",
+    on_stdout_line=None,
+    capture_stdout: bool = True,
+    capture_stderr: bool = True
+) -> tuple[bytes, bytes, int]:
     """
     Асинхронный запуск команды сканирования с таймаутом.
-    Возвращает (stdout, stderr).
+    Возвращает (stdout, stderr, код возврата). stderr — сырые байты: декодировать только на пути ошибки.
+    Запуск целиком в отдельном потоке: Popen блокирует вызывающий поток до execve()
+    (fork + чтение служебного pipe), а при загруженном диске это сотни мс простоя event loop.
+    on_stdout_line (необязательно) вызывается в этом же потоке для каждой строки stdout по мере вывода.
+    Отмена задачи поток не прерывает, поэтому при CancelledError группе процессов шлётся SIGTERM
+    (и SIGKILL через SCAN_KILL_GRACE) — поток дочитывает pipe и завершается сам, сканер освобождается.
     """
     logger.info(f"Запускаю: {' '.join(cmd)}")
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
+    state = {'process': None, 'cancelled': False}
     try:
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
-    except asyncio.TimeoutError:
-        process.terminate()
-        try:
-            await process.wait()
-        except Exception:
-            process.kill()
+        result = await asyncio.to_thread(
+            _run_command_blocking, cmd, timeout, on_stdout_line, capture_stdout, capture_stderr, state
+        )
+    except asyncio.CancelledError:
+        state['cancelled'] = True
+        process = state['process']
+        if process is not None:
+            _signal_process_group(process, signal.SIGTERM)
+            asyncio.get_running_loop().call_later(
+                SCAN_KILL_GRACE, _signal_process_group, process, signal.SIGKILL
+            )
+        raise
+    if result is None:
         raise RuntimeError(f"Таймаут ({timeout} сек) при {description}")
-
-    return stdout, stderr, process.returncode
+    return result
 
 
 async def auto_detect_scanner() -> str:
-    """Автоопределяет устройство сканера с помощью scanimage -L."""
+    """
+    Возвращает устройство сканера: заданное в конфиге (если автоопределение выключено),
+    из кеша (если моложе SCANNER_CACHE_TTL) или через scanimage -L.
+    Лок не даёт параллельным сканам запускать определение одновременно.
+    """
+    global _scanner_cache
+    if not SCAN_AUTODETECT:
+        return SCANNER_DEVICE  # Админ указал устройство явно — scanimage -L не нужен.
+    cached = _scanner_cache
+    if cached and time.monotonic() - cached[1] < SCANNER_CACHE_TTL:
+        return cached[0]
+
+    async with _get_scanner_lock():
+        cached = _scanner_cache  # Пока ждали лок, кеш мог заполнить другой скан.
+        if cached and time.monotonic() - cached[1] < SCANNER_CACHE_TTL:
+            return cached[0]
+        device = await _detect_scanner()
+        if device is not None:
+            _scanner_cache = (device, time.monotonic())
+        return device or SCANNER_DEVICE
+
+
+def _parse_scanner_device(output: str) -> Optional[str]:
+    """
+    Достаёт первое устройство из вывода scanimage -L (строки вида "device `xerox_mfp:libusb:001:004' is a ...").
+    Обычный формат разбирается через partition; регулярка — только если пробелы нестандартные.
+    """
+    _before, sep, rest = output.partition("device `")
+    if sep:
+        device, closed, _after = rest.partition("'")
+        if closed and device:
+            return device
+    match = _DEVICE_RE.search(output)
+    return match.group(1) if match else None
+
+
+async def _detect_scanner() -> Optional[str]:
+    """Определяет устройство сканера с помощью scanimage -L. None — не удалось (в кеш не попадает)."""
     try:
         stdout, stderr, returncode = await _run_scan_command(
             ['scanimage', '-L'],
@@ -54,50 +306,67 @@ async def auto_detect_scanner() -> str:
         )
         if returncode != 0:
             logger.warning(f"Ошибка автоопределения сканера: {stderr.decode(errors='replace')}")
-            return SCANNER_DEVICE
+            return None
 
-        output = stdout.decode(errors='replace')
-        match = re.search(r"device\s+`([^']+)'", output)
-        if match:
-            detected_device = match.group(1)
+        detected_device = _parse_scanner_device(stdout.decode(errors='replace'))
+        if detected_device:
             logger.info(f"Автоопределен сканер: {detected_device}")
             return detected_device
         else:
             logger.warning("Сканер не найден, использую дефолт")
-            return SCANNER_DEVICE
+            return None
     except Exception as e:
         logger.error(f"Ошибка автоопределения: {e}")
-        return SCANNER_DEVICE
+        return None
+
+
+@asynccontextmanager
+async def _scan_workdir(prefix: str):
+    """
+    Готовит скан: отдаёт (устройство сканера, временная директория), по выходе удаляет директорию.
+    Автоопределение (scanimage -L при холодном кеше) и создание директории идут одновременно.
+    """
+    scanner_task = asyncio.create_task(auto_detect_scanner())
+    try:
+        tmpdir = await asyncio.to_thread(tempfile.mkdtemp, prefix=prefix)
+    except BaseException:
+        scanner_task.cancel()
+        raise
+    try:
+        yield await scanner_task, tmpdir
+    finally:
+        await asyncio.to_thread(shutil.rmtree, tmpdir, ignore_errors=True)
 
 
+@_exclusive_of_warmup
 async def scan_single_page() -> str:
-    """Сканирует один лист с планшета (PNM, 600dpi). Асинхронно."""
-    scanner = await auto_detect_scanner()
-    with tempfile.TemporaryDirectory(prefix="scan_single_") as tmpdir:
+    """Сканирует один лист с планшета (SCAN_OPTIONS['format'], 600dpi). Асинхронно."""
+    async with _scan_workdir("scan_single_") as (scanner, tmpdir):
         try:
-            logger.info("Начинаю сканирование одного листа (PNM, 600dpi)")
-            scan_path = os.path.join(tmpdir, 'scan.pnm')
+            logger.info(f"Начинаю сканирование одного листа ({SCAN_OPTIONS['format']}, 600dpi)")
+            scan_path = os.path.join(tmpdir, 'scan' + _SCAN_EXT)
             cmd = [
                 'scanimage', '-d', scanner,
                 '--format', SCAN_OPTIONS['format'],
                 '--resolution', SCAN_OPTIONS['resolution'],
                 '--mode', SCAN_OPTIONS['mode'],
                 '--source', 'Flatbed',
-                '--progress',
                 '-o', scan_path
             ]
             _stdout, stderr, returncode = await _run_scan_command(
-                cmd, timeout=120.0, description="сканирование одного листа"
+                cmd, timeout=120.0, description="сканирование одного листа",
+                capture_stdout=False  # Изображение пишется в файл (-o), stdout не нужен.
             )
             if returncode != 0:
                 error_text = stderr.decode(errors='replace').strip()
+                _check_scan_error(error_text)
                 raise RuntimeError(f"Ошибка сканирования: {error_text or 'Неизвестная ошибка'}")
 
             if not os.path.exists(scan_path) or os.path.getsize(scan_path) == 0:
                 raise RuntimeError("Сканированный файл пуст или не создан")
 
             logger.info(f"Сканирование успешно: {scan_path}")
-            return create_temp_copy(scan_path, '.pnm')
+            return create_temp_copy(scan_path, _SCAN_EXT, move=True)
 
         except RuntimeError as e:
             if "Таймаут" in str(e):
@@ -109,14 +378,36 @@ async def scan_single_page() -> str:
             raise
 
 
+def _collect_batch_pages(tmpdir: str) -> list[tuple[int, str]]:
+    """
+    Возвращает непустые страницы пакетного скана scan_N<_SCAN_EXT> как (N, путь), по порядку номеров.
+    Один scandir вместо exists + getsize на каждую ожидаемую страницу.
+    Как и раньше, берём только непрерывную последовательность с 1: на пропуске останавливаемся.
+    """
+    pages = {}
+    ext_len = len(_SCAN_EXT)
+    with os.scandir(tmpdir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('scan_') and name.endswith(_SCAN_EXT) and name[5:-ext_len].isdigit():
+                if entry.stat().st_size > 0:
+                    pages[int(name[5:-ext_len])] = entry.path
+    result = []
+    page_num = 1
+    while page_num in pages:
+        result.append((page_num, pages[page_num]))
+        page_num += 1
+    return result
+
+
+@_exclusive_of_warmup
 async def scan_multiple_pages() -> list[str]:
-    """Сканирует несколько листов с автоподатчика (PNM, 600dpi). Асинхронно."""
-    scanner = await auto_detect_scanner()
-    with tempfile.TemporaryDirectory(prefix="scan_multi_") as tmpdir:
+    """Сканирует несколько листов с автоподатчика (SCAN_OPTIONS['format'], 600dpi). Асинхронно."""
+    async with _scan_workdir("scan_multi_") as (scanner, tmpdir):
         scanned_files = []
         try:
-            logger.info("Начинаю сканирование нескольких страниц (PNM, 600dpi)")
-            base_scan_path = os.path.join(tmpdir, 'scan_%d.pnm')
+            logger.info(f"Начинаю сканирование нескольких страниц ({SCAN_OPTIONS['format']}, 600dpi)")
+            base_scan_path = os.path.join(tmpdir, 'scan_%d' + _SCAN_EXT)
             cmd = [
                 'scanimage', '-d', scanner,
                 '--format', SCAN_OPTIONS['format'],
@@ -126,32 +417,42 @@ async def scan_multiple_pages() -> list[str]:
                 '--batch', base_scan_path,
                 '--batch-start', '1',
                 '--batch-increment', '1',
-                '--batch-count', '50'
+                '--batch-count', '50',
+                '--batch-print'
             ]
+
+            def on_page_done(page_path: str):
+                # scanimage печатает имя каждого готового файла: копируем страницу,
+                # пока сканер тянет следующий лист (вызывается в потоке _run_scan_command).
+                try:
+                    if not page_path or os.path.getsize(page_path) == 0:
+                        return
+                except OSError:
+                    return
+                scanned_files.append(create_temp_copy(page_path, _SCAN_EXT, move=True))
+                logger.info(f"Страница {len(scanned_files)} отсканирована")
+
             _stdout, stderr, returncode = await _run_scan_command(
-                cmd, timeout=600.0, description="многолистовое сканирование"
+                cmd, timeout=600.0, description="многолистовое сканирование",
+                on_stdout_line=on_page_done
             )
 
-            # Собираем отсканированные файлы
-            page_num = 1
-            while True:
-                page_path = os.path.join(tmpdir, f'scan_{page_num}.pnm')
-                if os.path.exists(page_path) and os.path.getsize(page_path) > 0:
-                    scanned_files.append(create_temp_copy(page_path, '.pnm'))
+            # Если scanimage не вывел имена файлов — собираем их одним проходом по каталогу
+            if not scanned_files:
+                for page_num, page_path in _collect_batch_pages(tmpdir):
+                    scanned_files.append(create_temp_copy(page_path, _SCAN_EXT, move=True))
                     logger.info(f"Страница {page_num} отсканирована")
-                    page_num += 1
-                else:
-                    break
 
             # Фоллбэк: один файл без нумерации
             if not scanned_files:
-                alt_page_path = os.path.join(tmpdir, 'scan.pnm')
+                alt_page_path = os.path.join(tmpdir, 'scan' + _SCAN_EXT)
                 if os.path.exists(alt_page_path) and os.path.getsize(alt_page_path) > 0:
-                    scanned_files.append(create_temp_copy(alt_page_path, '.pnm'))
+                    scanned_files.append(create_temp_copy(alt_page_path, _SCAN_EXT, move=True))
                     logger.info("1 страница отсканирована (одиночный файл)")
 
             if returncode != 0 and not scanned_files:
                 error_text = stderr.decode(errors='replace').strip()
+                _check_scan_error(error_text)
                 raise RuntimeError(f"Ошибка сканирования: {error_text or 'Неизвестная ошибка'}")
 
             if not scanned_files:
@@ -173,26 +474,76 @@ async def scan_multiple_pages() -> list[str]:
             raise
 
 
-async def convert_images_to_pdf(image_paths: list[str]) -> str:
-    """Конвертирует список PNM-изображений в PDF с помощью img2pdf. Асинхронно."""
-    with tempfile.TemporaryDirectory(prefix="conv_imgs_to_pdf_") as tmpdir:
-        try:
-            logger.info(f"Конвертирую {len(image_paths)} PNM в PDF")
-            pdf_path = os.path.join(tmpdir, 'scanned.pdf')
-            cmd = [sys.executable, '-m', 'img2pdf', '--output', pdf_path] + image_paths
+def _images_to_pdf_file(image_paths: list[str]) -> str:
+    """
+    Собирает PDF из изображений через img2pdf в текущем процессе (блокирующая, для asyncio.to_thread).
+    Пишет сразу во временный файл и возвращает путь к нему.
+    """
+    fd, pdf_path = tempfile.mkstemp(suffix='.pdf', prefix='scanned_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img2pdf.convert(image_paths, outputstream=f)
+    except BaseException:
+        os.unlink(pdf_path)
+        raise
+    return pdf_path
 
-            _stdout, stderr, returncode = await _run_scan_command(
-                cmd, timeout=60.0, description="конвертация изображений в PDF"
-            )
 
-            if returncode != 0:
-                error_text = stderr.decode(errors='replace').strip()
-                raise RuntimeError(f"Ошибка img2pdf: {error_text or 'Неизвестная ошибка'}")
+def _merge_pdf_files(part_paths: list[str]) -> str:
+    """
+    Склеивает PDF-части в один файл по порядку (блокирующая, для asyncio.to_thread).
+    Потоки изображений копируются как есть, без перекодирования. Части удаляются.
+    """
+    writer = pypdf.PdfWriter()
+    for path in part_paths:
+        writer.append(path)
+    fd, pdf_path = tempfile.mkstemp(suffix='.pdf', prefix='scanned_')
+    with os.fdopen(fd, 'wb') as f:
+        writer.write(f)
+    for path in part_paths:
+        os.unlink(path)
+    return pdf_path
 
-            if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0:
-                raise RuntimeError("Созданный PDF пуст")
 
-            return create_temp_copy(pdf_path, '.pdf')
-        except Exception as e:
-            logger.error(f"Ошибка конвертации изображений в PDF: {e}")
-            raise
\ No newline at end of file
+async def _images_to_pdf_parallel(image_paths: list[str], executor) -> str:
+    """
+    Делит страницы на непрерывные куски, собирает PDF каждого куска в пуле процессов
+    (сжатие растров img2pdf упирается в CPU и GIL) и склеивает части по порядку.
+    """
+    loop = asyncio.get_running_loop()
+    chunk_size = -(-len(image_paths) // PDF_POOL_WORKERS)  # Округление вверх.
+    chunks = [image_paths[i:i + chunk_size] for i in range(0, len(image_paths), chunk_size)]
+    results = await asyncio.gather(
+        *(loop.run_in_executor(executor, _images_to_pdf_file, chunk) for chunk in chunks),
+        return_exceptions=True
+    )
+    parts = [r for r in results if isinstance(r, str)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        for path in parts:
+            os.unlink(path)
+        raise errors[0]
+    return await asyncio.to_thread(_merge_pdf_files, parts)
+
+
+async def convert_images_to_pdf(image_paths: list[str], executor=None) -> str:
+    """
+    Конвертирует список сканов (TIFF/PNM) в PDF с помощью img2pdf. Асинхронно.
+    img2pdf вызывается как библиотека в потоке: без запуска отдельного интерпретатора на каждую конвертацию.
+    Если передан executor (пул процессов) и страниц больше PARALLEL_PDF_MIN_PAGES — страницы собираются параллельно.
+    """
+    try:
+        logger.info(f"Конвертирую {len(image_paths)} изображений в PDF")
+        if executor is not None and len(image_paths) > PARALLEL_PDF_MIN_PAGES:
+            pdf_path = await _images_to_pdf_parallel(image_paths, executor)
+        else:
+            pdf_path = await asyncio.to_thread(_images_to_pdf_file, image_paths)
+
+        if os.path.getsize(pdf_path) == 0:
+            os.unlink(pdf_path)
+            raise RuntimeError("Созданный PDF пуст")
+
+        return pdf_path
+    except Exception as e:
+        logger.error(f"Ошибка конвертации изображений в PDF: {e}")
+        raise
\ No newline at end of file
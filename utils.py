@@ -3,86 +3,173 @@
 # файлами и проверками.
 
 import os  # Импорт os для работы с файлами и путями.
+import asyncio
+import errno
 import json  # Импорт json для чтения/записи JSON файлов.
 import logging  # Импорт logging для логирования сообщений.
 import tempfile  # Импорт tempfile для создания временных файлов и директорий.
 import shutil  # Импорт shutil для копирования файлов.
-import re  # Импорт re для регулярных выражений (поиска по шаблонам).
 import time  # Импорт time для работы со временем (например, проверка возраста файлов).
+from typing import Optional
 
-from config import ADMIN_ID, ALLOWED_USERS_FILE  # Импорт конкретных переменных из config.py.
+from config import ADMIN_ID, ALLOWED_USERS_FILE, SUPPORTED_FORMATS  # Импорт конкретных переменных из config.py.
 
 logger = logging.getLogger(__name__)  # Создаем объект логгера с именем текущего модуля (__name__ - специальная переменная, равная имени файла без .py).
 
+# Наборы расширений по типам — создаются один раз при импорте, а не при каждом вызове is_*.
+_OFFICE_EXTS = frozenset({'.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.odt', '.ods'})
+_IMAGE_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif'})
+_TEXT_EXTS = frozenset({'.txt', '.rtf'})
+
+# Префиксы временных файлов бота, которые подчищает cleanup_temp_files.
+TEMP_FILE_PREFIXES = ('temp_', 'converted_', 'image_', 'gray_', 'blank_', 'booklet_', 'scan_', 'scanned_')
+
+# Кеш разобранного allowed_users.json: пока mtime файла не изменился, повторно его не читаем.
+_users_cache: Optional[set] = None
+_users_mtime: int = -1
+
 def load_allowed_users() -> set:  # Определяем функцию load_allowed_users, которая возвращает set (множество уникальных элементов).
-    """Загружает список разрешенных пользователей из файла."""  # Docstring - описание функции.
-    if os.path.exists(ALLOWED_USERS_FILE):  # Проверяем, существует ли файл с помощью os.path.exists (возвращает True/False).
-        try:  # Начинаем блок try для перехвата ошибок.
-            with open(ALLOWED_USERS_FILE, 'r') as f:  # Открываем файл на чтение ('r'), with автоматически закрывает файл после блока.
-                data = json.load(f)  # Загружаем содержимое файла как JSON в словарь data.
-                return set(data.get('allowed_users', []))  # Возвращаем множество из списка по ключу 'allowed_users', get возвращает дефолт [] если ключа нет.
-        except Exception as e:  # Ловим любую ошибку (Exception - базовый класс ошибок), сохраняем в e.
-            logger.error(f"Ошибка загрузки пользователей: {e}")  # Логируем ошибку с помощью logger.error, f-строка для вставки переменной.
-    return {ADMIN_ID}  # Если файл не существует или ошибка, возвращаем множество с одним ADMIN_ID.
+    """
+    Загружает список разрешенных пользователей из файла.
+    Если файл не менялся с прошлого чтения (тот же st_mtime_ns) — отдаёт копию кеша: один stat вместо open + JSON.
+    """
+    global _users_cache, _users_mtime
+    try:
+        mtime = os.stat(ALLOWED_USERS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return {ADMIN_ID}  # Если файл не существует, возвращаем множество с одним ADMIN_ID.
+    if mtime == _users_mtime and _users_cache is not None:
+        return set(_users_cache)  # Копия: вызывающий код меняет множество (add/remove), кеш должен остаться прежним.
+    try:  # Начинаем блок try для перехвата ошибок.
+        with open(ALLOWED_USERS_FILE, 'r') as f:  # Открываем файл на чтение ('r'), with автоматически закрывает файл после блока.
+            data = json.load(f)  # Загружаем содержимое файла как JSON в словарь data.
+        _users_cache = set(data.get('allowed_users', []))  # Множество из списка по ключу 'allowed_users', get возвращает дефолт [] если ключа нет.
+        _users_mtime = mtime
+        return set(_users_cache)
+    except Exception as e:  # Ловим любую ошибку (Exception - базовый класс ошибок), сохраняем в e.
+        logger.error(f"Ошибка загрузки пользователей: {e}")  # Логируем ошибку с помощью logger.error, f-строка для вставки переменной.
+    return {ADMIN_ID}  # Если ошибка, возвращаем множество с одним ADMIN_ID.
 
 def save_allowed_users(allowed_users: set):  # Определяем функцию save_allowed_users с параметром allowed_users (тип set).
-    """Сохраняет список разрешенных пользователей в файл."""  # Docstring.
+    """
+    Сохраняет список разрешенных пользователей в файл.
+    JSON собирается в bytes и пишется одним write() в уникальный временный файл рядом с основным,
+    затем fsync и атомарная подмена (os.replace): сбой посреди записи не оставит битый JSON.
+    Блокирующая функция — из обработчиков вызывать через asyncio.to_thread.
+    """
+    global _users_cache, _users_mtime
+    data = json.dumps({'allowed_users': list(allowed_users)}).encode()  # Словарь с ключом 'allowed_users' и списком из set в JSON.
+    tmp_path = None
     try:  # Блок try.
-        with open(ALLOWED_USERS_FILE, 'w') as f:  # Открываем файл на запись ('w').
-            json.dump({'allowed_users': list(allowed_users)}, f)  # Сохраняем словарь с ключом 'allowed_users' и списком из set в JSON.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(ALLOWED_USERS_FILE) or '.', prefix='.allowed_users_', suffix='.tmp'
+        )
+        with os.fdopen(fd, 'wb') as f:  # Временный файл на запись в бинарном режиме.
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())  # Данные на диске до подмены — после сбоя питания не будет пустого файла.
+        os.replace(tmp_path, ALLOWED_USERS_FILE)  # Атомарная подмена файла.
+        tmp_path = None
+        # Записанное сразу попадает в кеш — следующий load_allowed_users не перечитывает файл.
+        _users_cache = set(allowed_users)
+        _users_mtime = os.stat(ALLOWED_USERS_FILE).st_mtime_ns
     except Exception as e:  # Ловим ошибку.
         logger.error(f"Ошибка сохранения пользователей: {e}")  # Логируем.
-
-def is_user_allowed(user_id: int, allowed_users: set) -> bool:  # Функция проверяет доступ, возвращает bool (True/False).
-    """Проверяет, есть ли у пользователя доступ."""  # Docstring.
-    return user_id in allowed_users  # Возвращаем True если user_id в множестве, иначе False. in - оператор проверки наличия.
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
 
 def is_admin(user_id: int) -> bool:  # Функция проверяет, является ли пользователь админом.
     """Проверяет, является ли пользователь администратором."""  # Docstring.
     return user_id == ADMIN_ID  # Возвращаем True если user_id равен ADMIN_ID (== - сравнение).
 
+def short_err(e: Exception, n: int = 120) -> str:
+    """Текст исключения, обрезанный до n символов — для сообщений пользователю."""
+    s = str(e)
+    return s if len(s) <= n else s[:n]
+
 def get_file_extension(filename: str) -> str:  # Функция возвращает расширение файла.
     """Возвращает расширение файла в нижнем регистре."""  # Docstring.
     return os.path.splitext(filename)[1].lower()  # os.path.splitext разбивает на (имя, расширение), [1] - расширение, lower() - в нижний регистр.
 
+def is_supported_format(file_ext: str) -> bool:
+    """Проверяет, поддерживается ли расширение (ожидается уже в нижнем регистре)."""
+    return file_ext in SUPPORTED_FORMATS  # frozenset: один хэш + сравнение на C-уровне.
+
 def is_office_document(file_ext: str) -> bool:  # Функция проверяет, является ли расширение офисным документом.
     """Проверяет, является ли файл документом Office."""  # Docstring.
-    office_extensions = frozenset({'.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.odt', '.ods'})
-    return file_ext in office_extensions
+    return file_ext in _OFFICE_EXTS
 
 def is_image_file(file_ext: str) -> bool:  # Аналогичная функция для изображений.
     """Проверяет, является ли файл изображением."""  # Docstring.
-    image_extensions = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif'})
-    return file_ext in image_extensions
+    return file_ext in _IMAGE_EXTS
 
 def is_text_file(file_ext: str) -> bool:  # Аналогичная функция для текстовых файлов.
     """Проверяет, является ли файл текстовым."""  # Docstring.
-    text_extensions = frozenset({'.txt', '.rtf'})
-    return file_ext in text_extensions
+    return file_ext in _TEXT_EXTS
 
-def create_temp_copy(file_path: str, suffix: str = None) -> str:  # Функция создает временную копию файла.
-    """Создает временную копию файла."""  # Docstring.
+def create_temp_copy(file_path: str, suffix: str = None, move: bool = False) -> str:  # Функция создает временную копию файла.
+    """
+    Создает временную копию файла.
+    move=True — исходный файл больше не нужен вызывающему: он переименовывается (без копирования данных),
+    а если лежит на другой файловой системе — копируется (sendfile) и удаляется.
+    """
     if suffix is None:  # Проверяем, если suffix не задан (None - отсутствие значения).
         suffix = os.path.splitext(file_path)[1]  # Получаем расширение из file_path.
     temp_file = tempfile.NamedTemporaryFile(suffix=suffix, prefix='temp_', delete=False)  # Создаем временный файл с суффиксом и префиксом, delete=False - не удалять автоматически.
     temp_file.close()  # Закрываем файл (tempfile.NamedTemporaryFile открывает его).
+    if move:
+        try:
+            os.replace(file_path, temp_file.name)  # Та же ФС — только запись в каталоге.
+            return temp_file.name
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                os.unlink(temp_file.name)
+                raise
+        shutil.copyfile(file_path, temp_file.name)  # Другая ФС: copyfile на Linux использует sendfile.
+        os.unlink(file_path)
+        return temp_file.name
     shutil.copy2(file_path, temp_file.name)  # Копируем содержимое file_path в новый временный файл.
     return temp_file.name  # Возвращаем путь к временному файлу.
 
-def cleanup_temp_files():  # Функция очищает старые временные файлы.
-    """Очищает старые временные файлы (старше 1 часа)."""  # Docstring.
+def cleanup_temp_files(keep: frozenset = frozenset()):  # Функция очищает старые временные файлы.
+    """
+    Очищает старые временные файлы (старше 1 часа), кроме путей из keep (файлы живых сессий печати).
+    Сначала дешёвая проверка префикса по имени из readdir; тип файла берётся из d_type (is_file),
+    а единственный stat (lstat, без перехода по ссылкам) делается только для файлов бота.
+    """  # Docstring.
     temp_dir = tempfile.gettempdir()
-    pattern = re.compile(r'^(temp_|converted_|image_|gray_|blank_|booklet_|scan_|scanned_)')
-    now = time.time()
+    cutoff = time.time() - 3600
     try:
         with os.scandir(temp_dir) as entries:
             for entry in entries:
-                if entry.is_file(follow_symlinks=False) and pattern.match(entry.name):
-                    try:
-                        if now - entry.stat().st_mtime > 3600:
-                            os.unlink(entry.path)
-                            logger.info(f"Очищен старый временный файл: {entry.name}")
-                    except Exception as e:
-                        logger.error(f"Не удалось удалить {entry.name}: {e}")
+                if not entry.name.startswith(TEMP_FILE_PREFIXES) or not entry.is_file(follow_symlinks=False):
+                    continue
+                if entry.path in keep:
+                    continue  # Пользователь ещё не выбрал режим печати — файл нужен, сколько бы ему ни было.
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                    if mtime < cutoff:
+                        os.unlink(entry.path)
+                        logger.info(f"Очищен старый временный файл: {entry.name}")
+                except FileNotFoundError:
+                    pass  # Файл уже удалил его владелец.
+                except Exception as e:
+                    logger.error(f"Не удалось удалить {entry.name}: {e}")
     except Exception as e:
-        logger.error(f"Ошибка при очистке временных файлов: {e}")
\ No newline at end of file
+        logger.error(f"Ошибка при очистке временных файлов: {e}")
+
+
+async def cleanup_temp_files_periodic(interval: float = 3600, in_use=None):
+    """
+    Фоновая задача: раз в interval секунд чистит старые временные файлы.
+    scandir и unlink — блокирующие системные вызовы, поэтому сама очистка идёт в отдельном потоке.
+    in_use (необязательно) — функция без аргументов, возвращающая пути, которые удалять нельзя;
+    вызывается в event loop, до ухода в поток, чтобы не обходить user_data параллельно с обработчиками.
+    """
+    while True:
+        keep = frozenset(in_use()) if in_use else frozenset()
+        await asyncio.to_thread(cleanup_temp_files, keep)
+        await asyncio.sleep(interval)
\ No newline at end of file